@@ -0,0 +1,184 @@
+import platform
+import random
+import time
+import django
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from . import diffs, forms, models, parser, thumbnails, utils
+
+WORDS = (u"wiki page revision history search link image table list header "
+        u"server client request response cache index query render parser "
+        u"editor author change content title section paragraph word text "
+        u"alpha beta gamma delta epsilon zeta theta kappa lambda sigma omega").split()
+
+# approximate length of the generated pages, in characters
+PAGE_SIZES = (1000, 10000, 100000)
+
+
+class CorpusGenerator(object):
+    """
+    Fills the database with a reproducible synthetic wiki: pages of the
+    given sizes in turn, with links and images at the given densities, and
+    a page with a deep history.
+    """
+
+    def __init__(self, pages=100, history=100, images=20, link_density=0.05,
+            image_density=0.01, sizes=PAGE_SIZES, seed=0):
+        self.pages = pages
+        self.sizes = sizes
+        self.history = history
+        self.images = images
+        self.link_density = link_density
+        self.image_density = image_density
+        self.random = random.Random(seed)
+
+    def sentence(self):
+        words = []
+        for i in range(self.random.randint(5, 15)):
+            roll = self.random.random()
+            if roll < self.link_density:
+                words.append(u"[[Page %d]]" % self.random.randrange(self.pages * 2))
+            elif roll < self.link_density + self.image_density and self.images:
+                words.append(u"{{Image %d.png|200x150|%s}}" % (
+                        self.random.randrange(self.images), self.random.choice(WORDS)))
+            else:
+                words.append(self.random.choice(WORDS))
+        return u" ".join(words).capitalize() + u"."
+
+    def paragraph(self):
+        return u" ".join(self.sentence() for i in range(self.random.randint(2, 6)))
+
+    def content(self, size):
+        blocks = []
+        length = 0
+        while length < size:
+            if not blocks or self.random.random() < 0.1:
+                block = u"== %s ==" % self.random.choice(WORDS).capitalize()
+            elif self.random.random() < 0.1:
+                block = u"\n".join(u"* %s" % self.sentence() for i in range(3))
+            else:
+                block = self.paragraph()
+            blocks.append(block)
+            length += len(block) + 2
+        return u"\n\n".join(blocks)
+
+    def edit(self, content):
+        paragraphs = content.split(u"\n\n")
+        paragraphs[self.random.randrange(len(paragraphs))] = self.paragraph()
+        return u"\n\n".join(paragraphs)
+
+    def save(self, page, content):
+        revision = models.PageRevision(page=page, content=content, description=u"Benchmark")
+        revision.save()
+        return revision
+
+    def generate(self):
+        images = [models.Image.objects.create(name=u"Image %d.png" % i) for i in range(self.images)]
+        models.ImageRevision.objects.bulk_create([
+                models.ImageRevision(image=image, file=u"djimages/benchmark/%d.png" % image.pk)
+                for image in images])
+        for revision in models.ImageRevision.objects.filter(image__in=images).select_related('image'):
+            revision.image.set_last_revision(revision)
+            # thumbnailing is done in the background and not measured here
+            for size in set(thumbnails.standard_sizes()) | set(['200x150']):
+                cache.set(thumbnails.cache_key(revision.file.name, size),
+                        {'url': u"/media/benchmark.png", 'width': 1, 'height': 1})
+        for i in range(self.pages):
+            page = models.Page.objects.create(title=u"Page %d" % i)
+            self.save(page, self.content(self.sizes[i % len(self.sizes)]))
+        deep = models.Page.objects.create(title=u"Deep history")
+        content = self.content(self.sizes[len(self.sizes) // 2])
+        for i in range(self.history):
+            self.save(deep, content)
+            content = self.edit(content)
+        return {'pages': self.pages + 1, 'history': self.history, 'images': self.images}
+
+
+class Benchmark(object):
+    """
+    Runs each timed function `repeat` times, recording the wall time and
+    the number of database queries of every run.
+    """
+
+    def __init__(self, repeat=5, sizes=PAGE_SIZES):
+        self.repeat = repeat
+        self.sizes = sizes
+        self.results = {}
+
+    def measure(self, name, func, setup=None):
+        times, queries = [], []
+        connection.use_debug_cursor = True
+        try:
+            for i in range(self.repeat):
+                if setup:
+                    setup()
+                del connection.queries[:]
+                start = time.time()
+                func()
+                times.append(time.time() - start)
+                queries.append(len(connection.queries))
+        finally:
+            connection.use_debug_cursor = None
+        times.sort()
+        self.results[name] = {
+            'runs': len(times),
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'max': times[-1],
+            'queries': max(queries),
+        }
+
+    def get(self, client, url, data=None):
+        response = client.get(url, data or {})
+        assert response.status_code == 200, "%s returned %d" % (url, response.status_code)
+
+    def run(self):
+        """
+        Measures the hot paths on a corpus made by CorpusGenerator. Cached
+        sections and diffs are dropped before each run, except for the
+        measurements named *_cached.
+        """
+        client = Client()
+        for i, size in enumerate(self.sizes):
+            page = models.Page.objects.select_related('current_revision').get(title=u"Page %d" % i)
+            content = page.last_revision().content
+            self.measure('render_%d' % size, lambda: parser.render(content),
+                    setup=parser.invalidate_sections)
+            self.measure('render_%d_cached' % size, lambda: parser.render(content))
+        self.measure('view_search', lambda: self.get(client, reverse('search'), {'q': WORDS[0]}))
+        self.measure('view_search_words', lambda: self.get(client, reverse('search'),
+                {'q': u" ".join(WORDS[:3])}))
+
+        deep = models.Page.objects.select_related('current_revision').get(title=u"Deep history")
+        url_title = utils.urlize_title(deep.title)
+        revisions = list(deep.revisions.order_by('created').values_list('pk', flat=True))
+        self.measure('view_history', lambda: self.get(client,
+                reverse('djiki-page-history', kwargs={'title': url_title})))
+        first, middle, last = revisions[0], revisions[len(revisions) // 2], revisions[-1]
+        self.measure('view_diff', lambda: self.get(client,
+                reverse('djiki-page-diff', kwargs={'title': url_title}),
+                {'from_revision_pk': first, 'to_revision_pk': last}),
+                setup=lambda: cache.delete(diffs.cache_key(first, last)))
+        self.measure('view_undo', lambda: self.get(client,
+                reverse('djiki-page-undo', kwargs={'title': url_title, 'revision_pk': last})))
+
+        base = models.PageRevision.objects.get(pk=middle)
+        ours = CorpusGenerator(seed=len(revisions)).edit(base.content)
+        def rebase():
+            form = forms.PageEditForm(data={'content': ours, 'description': u"Benchmark",
+                    'prev_revision': base.pk, 'tags': u""},
+                    instance=models.PageRevision(page=deep), page=deep)
+            form.is_valid()
+        self.measure('form_rebase', rebase)
+        return self.results
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
@@ -0,0 +1,107 @@
+from diff_match_patch import diff_match_patch
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import escape
+from django.utils.translation import ungettext
+
+from . import models
+from .timing import timed
+
+def line_mode_threshold():
+    return getattr(settings, 'DJIKI_DIFF_LINE_MODE_THRESHOLD', 20000)
+
+def context_lines():
+    return getattr(settings, 'DJIKI_DIFF_CONTEXT_LINES', 3)
+
+def cache_timeout():
+    return getattr(settings, 'DJIKI_DIFF_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+
+@timed('diff')
+def compute(src, dst):
+    dmp = diff_match_patch()
+    if max(len(src), len(dst)) > line_mode_threshold():
+        # compare whole lines, which is much faster on large texts
+        src_chars, dst_chars, lines = dmp.diff_linesToChars(src, dst)
+        diff = dmp.diff_main(src_chars, dst_chars, False)
+        dmp.diff_charsToLines(diff, lines)
+    else:
+        diff = dmp.diff_main(src, dst, True)
+    return diff
+
+def make_reverse_patch(src, dst):
+    """
+    Returns the patch turning `dst` back into `src`, in the text format of
+    diff_match_patch.
+    """
+    dmp = diff_match_patch()
+    reverse = [(-op, data) for op, data in compute(src, dst)]
+    return dmp.patch_toText(dmp.patch_make(dst, reverse))
+
+def apply_patch(patch, text):
+    """
+    Applies a patch made by make_reverse_patch to `text`, returning the result
+    and whether all of its parts applied.
+    """
+    dmp = diff_match_patch()
+    text, results = dmp.patch_apply(dmp.patch_fromText(patch), text)
+    return text, False not in results
+
+def cache_key(from_pk, to_pk):
+    return 'djiki-diff:%d:%d:%d' % (from_pk, to_pk, line_mode_threshold())
+
+def get_diff(from_pk, to_pk):
+    """
+    Returns the diff between contents of two revisions. As revisions never
+    change, the result is cached for good.
+    """
+    key = cache_key(from_pk, to_pk)
+    diff = cache.get(key)
+    if diff is None:
+        revisions = models.PageRevision.objects.in_bulk([from_pk, to_pk])
+        diff = compute(revisions[from_pk].content, revisions[to_pk].content)
+        cache.set(key, diff, cache_timeout())
+    return diff
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;")\
+            .replace(">", "&gt;").replace("\n", "&para;<br />")
+
+def render_html(diff, context=None, expand_url=None):
+    """
+    Renders the diff as HTML. If `context` is given, unchanged text is cut
+    down to that many lines around each change, and the gaps link to
+    `expand_url`.
+    """
+    html = []
+    last = len(diff) - 1
+    for i, (op, data) in enumerate(diff):
+        if op == diff_match_patch.DIFF_INSERT:
+            html.append(u'<span class="added">%s</span>' % _escape(data))
+        elif op == diff_match_patch.DIFF_DELETE:
+            html.append(u'<span class="removed">%s</span>' % _escape(data))
+        elif op == diff_match_patch.DIFF_EQUAL:
+            if context is None:
+                html.append(u'<span>%s</span>' % _escape(data))
+                continue
+            lines = data.splitlines(True)
+            head = tail = 0
+            if i > 0:
+                # unless a change ends with a newline, the first piece is its rest
+                head = context if diff[i - 1][1].endswith(u'\n') else context + 1
+            if i < last:
+                tail = context if data.endswith(u'\n') else context + 1
+            if len(lines) <= head + tail + 1:
+                html.append(u'<span>%s</span>' % _escape(data))
+                continue
+            if head:
+                html.append(u'<span>%s</span>' % _escape(u''.join(lines[:head])))
+            hidden = len(lines) - head - tail
+            gap = ungettext("%(count)d unchanged line", "%(count)d unchanged lines", hidden) % {
+                    'count': hidden}
+            if expand_url:
+                html.append(u'<a class="gap" href="%s">%s</a><br />' % (escape(expand_url), gap))
+            else:
+                html.append(u'<span class="gap">%s</span><br />' % gap)
+            if tail:
+                html.append(u'<span>%s</span>' % _escape(u''.join(lines[len(lines) - tail:])))
+    return u''.join(html)
@@ -1,9 +1,12 @@
 from django import forms
 from django.utils.translation import ugettext as _
-from diff_match_patch import diff_match_patch
 from . import models, utils
+from .merge import merge
+from .tags import set_tags
+from .timing import timed
 
 from taggit.forms import TagField
+from taggit.models import Tag
 from taggit.utils import parse_tags, edit_string_for_tags
 
 from taggit_autosuggest.widgets import TagAutoSuggest
@@ -29,32 +32,40 @@ class PageEditForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         self.page = kwargs.pop('page')
         super(PageEditForm, self).__init__(*args, **kwargs)
+        self.conflicts = []
         if self.page.pk:
             self.fields['tags'].initial = edit_string_for_tags(
-                    self.page.tags.all())
+                    [Tag(name=name) for name in self.page.tag_list()])
             self.fields['prev_revision'].queryset = self.page.revisions.all()
             self.fields['prev_revision'].initial = self.page.last_revision()
 
+    @timed('rebase')
     def _rebase(self, base, latest, our):
-        dmp = diff_match_patch()
-        diff = dmp.patch_make(base, our)
-        return dmp.patch_apply(diff, latest)
+        return merge(base, our, latest)
 
     def clean(self):
         base_revision = self.cleaned_data.get('prev_revision')
         last_revision = self.page.last_revision()
-        content = self.cleaned_data['content']
-        if base_revision != last_revision:
-            rebase_success = False
-            if base_revision:
-                content, results = self._rebase(base_revision.content, last_revision.content, content)
-                rebase_success = False not in results
-            if not rebase_success:
+        content = self.cleaned_data.get('content')
+        if base_revision != last_revision and content is not None:
+            if not base_revision:
+                raise forms.ValidationError(
+                        _("Somebody else has created this page in the meantime. Stash your "\
+                        "version somewhere else and reapply with the latest revision."))
+            result = self._rebase(base_revision.content, last_revision.content, content)
+            if result.conflicts:
+                # show the merged text with the conflicts marked, on top of
+                # the latest revision, for the editor to resolve them
+                self.conflicts = result.conflicts
+                self.data = self.data.copy()
+                self.data['content'] = result.text(ours_label=_("your version"),
+                        theirs_label=_("latest revision"))
+                self.data['prev_revision'] = last_revision.pk
                 raise forms.ValidationError(
-                        _("Somebody else has modified this page in the meantime. It is not "\
-                        "possible to merge all the changes automatically. Stash your version "\
-                        "somewhere else and reapply with the latest revision."))
-            self.cleaned_data['content'] = content
+                        _("Somebody else has modified this page in the meantime. Some of the "\
+                        "changes overlap yours and could not be merged automatically: please "\
+                        "resolve the marked conflicts below and save again."))
+            self.cleaned_data['content'] = result.text()
         return self.cleaned_data
 
     def clean_tags(self):
@@ -74,7 +85,7 @@ class PageEditForm(forms.ModelForm):
             self.page.save()
             self.instance.page = self.page
         print self.cleaned_data['tags']
-        self.page.tags.set(*self.cleaned_data['tags'])
+        set_tags(self.page, self.cleaned_data['tags'])
         super(PageEditForm, self).save(*args, **kwargs)
 
 
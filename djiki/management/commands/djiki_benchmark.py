@@ -0,0 +1,53 @@
+import json
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from djiki import benchmark
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = "Generates a synthetic wiki in a new test database, times rendering, search, " \
+            "history, diff, undo and edit rebases on it, and writes the results as JSON " \
+            "to the given file or to the standard output."
+    option_list = BaseCommand.option_list + (
+        make_option('--pages', type='int', dest='pages', default=100,
+            help="Number of generated pages, at least 3."),
+        make_option('--history', type='int', dest='history', default=100,
+            help="Number of revisions of the page with a deep history."),
+        make_option('--images', type='int', dest='images', default=20,
+            help="Number of generated images."),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+            help="Number of runs of every measurement."),
+        make_option('--seed', type='int', dest='seed', default=0,
+            help="Seed of the corpus generator."),
+    )
+
+    def handle(self, *args, **options):
+        if options['pages'] < 3 or options['history'] < 2:
+            raise CommandError("At least 3 pages and 2 revisions of history are needed.")
+        verbosity = int(options['verbosity'])
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            if verbosity:
+                sys.stderr.write("Generating the corpus...\n")
+            corpus = benchmark.CorpusGenerator(pages=options['pages'], history=options['history'],
+                    images=options['images'], seed=options['seed']).generate()
+            if verbosity:
+                sys.stderr.write("Measuring...\n")
+            results = benchmark.Benchmark(repeat=options['repeat']).run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        report = json.dumps({
+            'environment': benchmark.environment(),
+            'corpus': corpus,
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if args and args[0] != '-':
+            with open(args[0], 'w') as out:
+                out.write(report)
+        else:
+            self.stdout.write(report)
+            self.stdout.write('\n')
@@ -0,0 +1,48 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from djiki import models, utils
+
+class Command(NoArgsCommand):
+    help = "Converts the stored history of all pages to the delta storage with keyframes " \
+            "every DJIKI_REVISION_KEYFRAME_INTERVAL revisions, or back to full text."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--interval', type='int', dest='interval', default=None,
+            help="Keyframe interval to use instead of DJIKI_REVISION_KEYFRAME_INTERVAL. "
+                "Zero stores all revisions in full."),
+    )
+
+    def handle_noargs(self, **options):
+        interval = options['interval']
+        if interval is None:
+            interval = models.keyframe_interval()
+        verbosity = int(options['verbosity'])
+        for page_id in models.Page.objects.values_list('pk', flat=True).iterator():
+            changed = self.compact_page(page_id, interval)
+            if verbosity > 1:
+                self.stdout.write("Page %d: %d revisions converted\n" % (page_id, changed))
+
+    @transaction.commit_on_success
+    def compact_page(self, page_id, interval):
+        revisions = models.PageRevision.objects.filter(page=page_id)
+        position = revisions.count()
+        changed = 0
+        next_content = None
+        # walk from the latest revision, which is always stored in full,
+        # keeping only the content of the next revision in memory
+        for pk, content, delta in revisions.order_by('-created')\
+                .values_list('pk', 'content', 'delta').iterator():
+            position -= 1
+            if delta:
+                content = utils.apply_delta(next_content, delta)
+            if next_content is None or not interval or not position % interval:
+                new_content, new_delta = content, ''
+            else:
+                new_content, new_delta = '', utils.make_delta(next_content, content)
+            if new_delta != delta:
+                models.PageRevision.objects.filter(pk=pk).update(
+                        content=new_content, delta=new_delta)
+                changed += 1
+            next_content = content
+        return changed
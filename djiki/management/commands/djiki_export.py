@@ -0,0 +1,69 @@
+import base64
+import gzip
+import json
+import sys
+from django.core.management.base import BaseCommand
+
+from djiki import models, utils
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = "Writes all pages, revisions, tags and images as a line-delimited JSON archive " \
+            "to the given file (gzipped if its name ends with .gz) or to the standard output."
+
+    def handle(self, *args, **options):
+        if args and args[0] != '-':
+            opener = gzip.open if args[0].endswith('.gz') else open
+            out = opener(args[0], 'wb')
+        else:
+            out = sys.stdout
+        try:
+            self.export(out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    def write(self, out, record):
+        out.write(json.dumps(record))
+        out.write('\n')
+
+    def export(self, out):
+        for page in models.Page.objects.iterator():
+            self.write(out, {
+                'type': 'page',
+                'title': page.title,
+                'tags': [t.name for t in page.tags.all()],
+            })
+            revisions = models.PageRevision.objects.filter(page=page).order_by('-created')\
+                    .values_list('created', 'author__username', 'description', 'content', 'delta')
+            next_content = None
+            # latest first, so that delta stored content can be restored on the go
+            for created, author, description, content, delta in revisions.iterator():
+                if delta:
+                    content = utils.apply_delta(next_content, delta)
+                self.write(out, {
+                    'type': 'revision',
+                    'page': page.title,
+                    'created': created.isoformat(),
+                    'author': author,
+                    'description': description,
+                    'content': content,
+                })
+                next_content = content
+        for image in models.Image.objects.iterator():
+            self.write(out, {'type': 'image', 'name': image.name})
+            for revision in image.revisions.select_related('author').iterator():
+                revision.file.open('rb')
+                try:
+                    data = base64.b64encode(revision.file.read())
+                finally:
+                    revision.file.close()
+                self.write(out, {
+                    'type': 'image_revision',
+                    'image': image.name,
+                    'created': revision.created.isoformat(),
+                    'author': revision.author.username if revision.author else None,
+                    'description': revision.description,
+                    'file': revision.file.name,
+                    'data': data,
+                })
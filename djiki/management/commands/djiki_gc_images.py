@@ -0,0 +1,51 @@
+import os
+import time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from sorl.thumbnail import delete as delete_thumbnails
+
+from djiki import models
+from djiki.storage import image_storage
+
+class Command(NoArgsCommand):
+    help = "Deletes the stored image files, and their thumbnails, which no image revision refers to."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--min-age', type='int', dest='min_age', default=60 * 60,
+            help="Keep files younger than this many seconds, which may belong to uploads "
+                "in progress."),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help="Only list the files which would be deleted."),
+    )
+
+    def walk(self, path):
+        directories, files = image_storage.listdir(path)
+        for name in files:
+            yield os.path.join(path, name)
+        for directory in directories:
+            for name in self.walk(os.path.join(path, directory)):
+                yield name
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+        deadline = time.time() - options['min_age']
+        root = settings.DJIKI_IMAGES_PATH.rstrip('/')
+        if not image_storage.exists(root):
+            return
+        # collect the files first, so that no newer revision is missed
+        names = [n for n in self.walk(root)
+                if os.path.getmtime(image_storage.path(n)) < deadline]
+        referenced = set(models.ImageRevision.objects.values_list('file', flat=True))
+        deleted = 0
+        for name in names:
+            if name in referenced:
+                continue
+            if verbosity > 1 or options['dry_run']:
+                self.stdout.write("%s\n" % name)
+            if not options['dry_run']:
+                delete_thumbnails(name, delete_file=False)
+                image_storage.delete(name)
+            deleted += 1
+        if verbosity:
+            self.stdout.write("%d unreferenced files %s.\n" % (
+                    deleted, "found" if options['dry_run'] else "deleted"))
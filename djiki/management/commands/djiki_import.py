@@ -0,0 +1,192 @@
+import base64
+import gzip
+import json
+import sys
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from taggit.models import Tag, TaggedItem
+
+from djiki import models, pagecache, tags
+
+class Command(BaseCommand):
+    args = '[file]'
+    help = "Loads an archive written by djiki_export from the given file or the standard input. " \
+            "Revisions of pages and images that already exist are added to their history."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help="Number of records inserted with a single query."),
+        make_option('--no-reindex', action='store_false', dest='reindex', default=True,
+            help="Do not rebuild the link table and the search index afterwards."),
+    )
+
+    def handle(self, *args, **options):
+        if args and args[0] != '-':
+            opener = gzip.open if args[0].endswith('.gz') else open
+            source = opener(args[0], 'rb')
+        else:
+            source = sys.stdin
+        self.batch_size = options['batch_size']
+        self.pages, self.images, self.users, self.tags = {}, {}, {}, {}
+        self.page_batch, self.revision_batch = [], []
+        self.image_batch, self.image_revision_batch = [], []
+        self.tagged_batch = []
+        self.created_pages, self.image_names = [], set()
+        # keep the archived creation times
+        fields = [models.PageRevision._meta.get_field('created'),
+                models.ImageRevision._meta.get_field('created')]
+        for field in fields:
+            field.auto_now_add = False
+        try:
+            self.load(source)
+        finally:
+            for field in fields:
+                field.auto_now_add = True
+            if source is not sys.stdin:
+                source.close()
+        self.invalidate()
+        if options['reindex']:
+            call_command('djiki_reindex')
+
+    @transaction.commit_on_success
+    def load(self, source):
+        for line in source:
+            record = json.loads(line)
+            getattr(self, 'load_%s' % record['type'])(record)
+        self.flush_revisions()
+        self.flush_image_revisions()
+        self.flush_tags()
+        tags.recount()
+        self.fix_current_revisions(models.PageRevision, models.Page, 'page', self.pages.values())
+        self.fix_current_revisions(models.ImageRevision, models.Image, 'image', self.images.values())
+        models.invalidate_titles(models.Page)
+        models.invalidate_titles(models.Image)
+        models.invalidate_page_index(models.Page)
+
+    def invalidate(self):
+        """
+        Renders again the pages linking to the new pages and to the images
+        given revisions, as bulk inserts send no signals, and purges the
+        cached pages once the import is committed.
+        """
+        for title in self.created_pages:
+            models.invalidate_backlinks(models.PageLink.PAGE, title)
+        for name in self.image_names:
+            models.invalidate_backlinks(models.PageLink.IMAGE, name)
+        pagecache.purge(pagecache.LISTS, *[pagecache.page_group(title) for title in self.pages] +
+                [pagecache.image_group(name) for name in self.image_names])
+
+    def get_user(self, username):
+        if username not in self.users:
+            try:
+                self.users[username] = User.objects.get(username=username).pk
+            except User.DoesNotExist:
+                self.users[username] = None
+        return self.users[username]
+
+    def load_page(self, record):
+        self.page_batch.append(record)
+        if len(self.page_batch) >= self.batch_size:
+            self.flush_pages()
+
+    def flush_pages(self):
+        titles = [r['title'] for r in self.page_batch]
+        existing = set(models.Page.objects.filter(title__in=titles).values_list('title', flat=True))
+        created = [t for t in titles if t not in existing]
+        models.Page.objects.bulk_create([models.Page(title=t, initial=models.Page.get_initial(t))
+                for t in created])
+        self.created_pages.extend(created)
+        self.pages.update(models.Page.objects.filter(title__in=titles).values_list('title', 'pk'))
+        for record in self.page_batch:
+            for name in record['tags']:
+                if name not in self.tags:
+                    self.tags[name] = Tag.objects.get_or_create(name=name)[0].pk
+                self.tagged_batch.append((self.tags[name], self.pages[record['title']]))
+        self.page_batch = []
+
+    def load_revision(self, record):
+        if record['page'] not in self.pages:
+            self.flush_pages()
+        self.revision_batch.append(models.PageRevision(
+                page_id=self.pages[record['page']],
+                created=parse_datetime(record['created']),
+                author_id=record['author'] and self.get_user(record['author']),
+                description=record['description'],
+                content=record['content'],
+                current_version=False))
+        if len(self.revision_batch) >= self.batch_size:
+            self.flush_revisions()
+
+    def flush_revisions(self):
+        self.flush_pages()
+        models.PageRevision.objects.bulk_create(self.revision_batch)
+        self.revision_batch = []
+
+    def load_image(self, record):
+        self.image_batch.append(record['name'])
+        if len(self.image_batch) >= self.batch_size:
+            self.flush_images()
+
+    def flush_images(self):
+        names = self.image_batch
+        existing = set(models.Image.objects.filter(name__in=names).values_list('name', flat=True))
+        models.Image.objects.bulk_create([models.Image(name=n) for n in names if n not in existing])
+        self.images.update(models.Image.objects.filter(name__in=names).values_list('name', 'pk'))
+        self.image_batch = []
+
+    def load_image_revision(self, record):
+        if record['image'] not in self.images:
+            self.flush_images()
+        self.image_names.add(record['image'])
+        revision = models.ImageRevision(
+                image_id=self.images[record['image']],
+                created=parse_datetime(record['created']),
+                author_id=record['author'] and self.get_user(record['author']),
+                description=record['description'])
+        field = revision._meta.get_field('file')
+        name = field.generate_filename(revision, record['file'].rsplit('/', 1)[-1])
+        revision.file = field.storage.save(name, ContentFile(base64.b64decode(record['data'])))
+        self.image_revision_batch.append(revision)
+        if len(self.image_revision_batch) >= self.batch_size:
+            self.flush_image_revisions()
+
+    def flush_image_revisions(self):
+        self.flush_images()
+        models.ImageRevision.objects.bulk_create(self.image_revision_batch)
+        self.image_revision_batch = []
+
+    def flush_tags(self):
+        content_type = ContentType.objects.get_for_model(models.Page)
+        for start in range(0, len(self.tagged_batch), self.batch_size):
+            batch = self.tagged_batch[start:start + self.batch_size]
+            existing = set(TaggedItem.objects.filter(content_type=content_type,
+                    object_id__in=set(page for tag, page in batch)).values_list('tag', 'object_id'))
+            TaggedItem.objects.bulk_create([
+                    TaggedItem(tag_id=tag, object_id=page, content_type=content_type)
+                    for tag, page in batch if (tag, page) not in existing])
+        self.tagged_batch = []
+
+    def fix_current_revisions(self, revision_model, model, field, ids):
+        ids = list(ids)
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start + self.batch_size]
+            revisions = revision_model.objects.filter(**{'%s__in' % field: batch})
+            current = {}
+            for owner, pk, created in revisions.order_by(field, '-created', '-pk')\
+                    .values_list(field, 'pk', 'created').iterator():
+                current.setdefault(owner, (pk, created))
+            if revision_model is models.PageRevision:
+                revisions.filter(current_version=True).update(current_version=False)
+                revision_model.objects.filter(pk__in=[pk for pk, created in current.values()])\
+                        .update(current_version=True)
+            for owner, (pk, created) in current.iteritems():
+                if model is models.Page:
+                    model.objects.filter(pk=owner).update(current_revision=pk, modified=created)
+                else:
+                    model.objects.filter(pk=owner).update(current_revision=pk)
@@ -0,0 +1,44 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import Count
+
+from djiki import models, search, tags
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the current revision pointers, the page index, the tag counts, the " \
+            "link table and the search index from the latest revisions of all pages and images, " \
+            "and stores the missing patches between revisions."
+
+    def handle_noargs(self, **options):
+        backend = search.setup_backend()
+        for pk, title, initial in models.Page.objects.values_list('pk', 'title', 'initial').iterator():
+            if initial != models.Page.get_initial(title):
+                models.Page.objects.filter(pk=pk).update(initial=models.Page.get_initial(title))
+        revisions = models.PageRevision.objects.filter(current_version=True).select_related('page')
+        for revision in revisions.iterator():
+            revision.page.set_last_revision(revision)
+            models.update_links(revision)
+            backend.update(revision.page, revision.content)
+        # pages with revisions saved before the previous revision pointers
+        unlinked = models.PageRevision.objects.filter(previous__isnull=True)\
+                .values('page').annotate(count=Count('pk')).filter(count__gt=1).order_by()
+        for page_id in [row['page'] for row in unlinked]:
+            self.link_revisions(page_id)
+        for image in models.Image.objects.iterator():
+            try:
+                image.set_last_revision(image.revisions.order_by('-created')[0])
+            except IndexError:
+                pass
+        models.invalidate_titles(models.Page)
+        models.invalidate_titles(models.Image)
+        models.invalidate_page_index(models.Page)
+        tags.recount()
+
+    def link_revisions(self, page_id):
+        previous = None
+        for revision in models.PageRevision.objects.filter(page=page_id)\
+                .order_by('created', 'pk').iterator():
+            if previous and not revision.previous_id:
+                revision.set_previous(previous)
+                models.PageRevision.objects.filter(pk=revision.pk).update(previous=previous,
+                        reverse_patch=revision.reverse_patch)
+            previous = revision
@@ -0,0 +1,105 @@
+import multiprocessing
+import time
+from collections import deque
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from djiki import models, pagecache, parser
+
+def render_batch(pks, force=False):
+    """
+    Renders and stores the HTML of the given revisions, returning how many
+    of them were rendered.
+    """
+    rendered = 0
+    for revision in models.PageRevision.objects.filter(pk__in=pks).select_related('page')\
+            .defer('reverse_patch').iterator():
+        if force:
+            revision.rendered_version = ''
+        if revision.rendered_version != parser.render_version():
+            revision.render()
+            rendered += 1
+    pagecache.purge(*[pagecache.page_group(title) for title in
+            models.Page.objects.filter(current_revision__in=pks).values_list('title', flat=True)])
+    return rendered
+
+
+class Command(NoArgsCommand):
+    help = "Renders the current revisions of all pages whose HTML was made by an older parser " \
+            "version, in parallel processes. It can be interrupted and run again to go on."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers',
+            default=multiprocessing.cpu_count(),
+            help="Number of rendering processes. Zero renders in this process."),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help="Number of revisions given to a process at once."),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help="Render the revisions whose HTML is up to date, too."),
+        make_option('--start-after', type='int', dest='start_after', default=0,
+            help="Skip the revisions up to this primary key, as reported by an interrupted "
+                "run with --force."),
+    )
+
+    def batches(self, start_after, batch_size, force):
+        revisions = models.PageRevision.objects.filter(current_version=True)
+        if not force:
+            revisions = revisions.exclude(rendered_version=parser.render_version())
+        last = start_after
+        while True:
+            # walk the primary key index, instead of keeping a cursor open
+            pks = list(revisions.filter(pk__gt=last).order_by('pk')
+                    .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return
+            last = pks[-1]
+            yield pks
+
+    def collect(self):
+        pks, result = self.pending.popleft()
+        self.rendered += result.get() if self.workers else result
+        self.done += len(pks)
+        if self.verbosity:
+            elapsed = time.time() - self.start
+            self.stdout.write("%d/%d pages, %.1f pages/s, done up to revision %d\n" % (
+                    self.done, self.total, self.done / elapsed if elapsed else 0, pks[-1]))
+
+    def handle_noargs(self, **options):
+        self.verbosity = int(options['verbosity'])
+        self.workers, force = options['workers'], options['force']
+        revisions = models.PageRevision.objects.filter(current_version=True,
+                pk__gt=options['start_after'])
+        if not force:
+            revisions = revisions.exclude(rendered_version=parser.render_version())
+        self.total = revisions.count()
+        if force:
+            parser.invalidate_sections()
+        if self.workers:
+            # the processes must not share the connection of this one
+            connection.close()
+            pool = multiprocessing.Pool(self.workers)
+        self.start = time.time()
+        self.done = self.rendered = 0
+        self.pending = deque()
+        try:
+            for pks in self.batches(options['start_after'], options['batch_size'], force):
+                if self.workers:
+                    self.pending.append((pks, pool.apply_async(render_batch, (pks, force))))
+                else:
+                    self.pending.append((pks, render_batch(pks, force)))
+                # keep every process busy, without queueing the whole wiki
+                while len(self.pending) > self.workers * 2:
+                    self.collect()
+            while self.pending:
+                self.collect()
+        except:
+            if self.workers:
+                pool.terminate()
+            raise
+        if self.workers:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - self.start
+        if self.verbosity:
+            self.stdout.write("%d pages rendered in %.1f s, %.1f pages/s.\n" % (
+                    self.rendered, elapsed, self.rendered / elapsed if elapsed else 0))
@@ -0,0 +1,209 @@
+from bisect import bisect_left
+from diff_match_patch import diff_match_patch
+
+# gaps without unique common lines are aligned by the Myers diff of
+# diff_match_patch, one character per distinct line, up to this many
+# distinct lines, which stays below the surrogate code points
+MAX_CODES = 0xd000
+
+def unique_lines(lines, lo, hi):
+    """
+    Returns a dictionary mapping the lines seen once in lines[lo:hi] to
+    their index.
+    """
+    seen = {}
+    for i in xrange(lo, hi):
+        line = lines[i]
+        seen[line] = None if line in seen else i
+    return dict((line, i) for line, i in seen.iteritems() if i is not None)
+
+def longest_increasing(pairs):
+    """
+    Returns the longest subsequence of the (i, j) pairs, sorted by i, whose
+    second items increase too, in O(n log n) by patience sorting.
+    """
+    # the last pair of each pile, its second item, and the pair of the
+    # previous pile each pair was put on
+    tops, values, links = [], [], []
+    for n, (i, j) in enumerate(pairs):
+        pile = bisect_left(values, j)
+        links.append(tops[pile - 1] if pile else None)
+        if pile == len(tops):
+            tops.append(n)
+            values.append(j)
+        else:
+            tops[pile] = n
+            values[pile] = j
+    result = []
+    n = tops[-1] if tops else None
+    while n is not None:
+        result.append(pairs[n])
+        n = links[n]
+    result.reverse()
+    return result
+
+def _match(a, alo, ahi, b, blo, bhi, matches):
+    head = []
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        head.append((alo, blo))
+        alo += 1
+        blo += 1
+    tail = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        tail.append((ahi, bhi))
+    matches.extend(head)
+    if alo < ahi and blo < bhi:
+        unique_a = unique_lines(a, alo, ahi)
+        unique_b = unique_lines(b, blo, bhi)
+        anchors = longest_increasing(sorted((i, unique_b[line])
+                for line, i in unique_a.iteritems() if line in unique_b))
+        if anchors:
+            for i, j in anchors:
+                _match(a, alo, i, b, blo, j, matches)
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            _match(a, alo, ahi, b, blo, bhi, matches)
+        else:
+            _match_myers(a, alo, ahi, b, blo, bhi, matches)
+    matches.extend(reversed(tail))
+
+def _match_myers(a, alo, ahi, b, blo, bhi, matches):
+    codes = {}
+    for line in a[alo:ahi] + b[blo:bhi]:
+        codes.setdefault(line, unichr(len(codes)))
+    if len(codes) > MAX_CODES:
+        return
+    dmp = diff_match_patch()
+    diffs = dmp.diff_main(u"".join(codes[line] for line in a[alo:ahi]),
+            u"".join(codes[line] for line in b[blo:bhi]), False)
+    i, j = alo, blo
+    for op, text in diffs:
+        if op == dmp.DIFF_EQUAL:
+            matches.extend((i + n, j + n) for n in xrange(len(text)))
+        if op != dmp.DIFF_INSERT:
+            i += len(text)
+        if op != dmp.DIFF_DELETE:
+            j += len(text)
+
+def match_lines(a, b):
+    """
+    Returns the pairs of indexes of the lines of `a` and `b` kept unchanged
+    from `a` to `b`, in increasing order. This is a patience diff: common
+    prefixes and suffixes are matched first, then the lines found once in
+    both sides, recursively, which keeps it close to linear time on the
+    edits of a wiki page. The rest is left to a Myers diff.
+    """
+    matches = []
+    _match(a, 0, len(a), b, 0, len(b), matches)
+    return matches
+
+
+class Conflict(object):
+    """
+    A region changed differently by both sides, starting at `line` (from
+    1) of the merged text.
+    """
+
+    def __init__(self, line, base, ours, theirs):
+        self.line = line
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+
+
+class MergeResult(object):
+    """
+    The merged text, as a list of chunks which are either strings or
+    conflicts.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    @property
+    def conflicts(self):
+        return [chunk for chunk in self.chunks if isinstance(chunk, Conflict)]
+
+    def text(self, ours_label=u"yours", theirs_label=u"theirs"):
+        """
+        Returns the merged text, with the conflicts marked as in version
+        control systems.
+        """
+        text = []
+        for chunk in self.chunks:
+            if isinstance(chunk, Conflict):
+                text.append(u"<<<<<<< %s\n%s=======\n%s>>>>>>> %s\n" % (theirs_label,
+                        _terminated(chunk.theirs), _terminated(chunk.ours), ours_label))
+            else:
+                text.append(chunk)
+        return u"".join(text)
+
+def _terminated(text):
+    return text if not text or text.endswith(u"\n") else text + u"\n"
+
+def merge_chars(base, ours, theirs):
+    """
+    Applies the changes from `base` to `ours` to `theirs` character by
+    character, returning None unless all of them apply where their context
+    is found unchanged.
+    """
+    dmp = diff_match_patch()
+    dmp.Match_Threshold = 0.0
+    merged, results = dmp.patch_apply(dmp.patch_make(base, ours), theirs)
+    return merged if all(results) else None
+
+def merge(base, ours, theirs):
+    """
+    Merges the changes made from `base` to `ours` and to `theirs`, line by
+    line. Regions changed by both sides are merged character by character
+    when possible, and are returned as conflicts otherwise.
+    """
+    base_lines = base.splitlines(True)
+    our_lines = ours.splitlines(True)
+    their_lines = theirs.splitlines(True)
+    ours_at = dict(match_lines(base_lines, our_lines))
+    theirs_at = dict(match_lines(base_lines, their_lines))
+    chunks, merged = [], []
+    line = 1
+    i = j = k = 0
+    while True:
+        # the next base line kept by both sides
+        stable = i
+        while stable < len(base_lines) and not (stable in ours_at and stable in theirs_at):
+            stable += 1
+        if stable < len(base_lines):
+            end_j, end_k = ours_at[stable], theirs_at[stable]
+        else:
+            end_j, end_k = len(our_lines), len(their_lines)
+        if (stable, end_j, end_k) != (i, j, k):
+            base_chunk = u"".join(base_lines[i:stable])
+            our_chunk = u"".join(our_lines[j:end_j])
+            their_chunk = u"".join(their_lines[k:end_k])
+            if our_chunk == base_chunk or our_chunk == their_chunk:
+                resolved = their_chunk
+            elif their_chunk == base_chunk:
+                resolved = our_chunk
+            elif base_chunk:
+                resolved = merge_chars(base_chunk, our_chunk, their_chunk)
+            else:
+                # both sides inserted something different at the same place
+                resolved = None
+            if resolved is None:
+                if merged:
+                    chunks.append(u"".join(merged))
+                    merged = []
+                chunks.append(Conflict(line, base_chunk, our_chunk, their_chunk))
+                line += 3 + len(their_chunk.splitlines()) + len(our_chunk.splitlines())
+            else:
+                merged.append(resolved)
+                line += resolved.count(u"\n")
+        if stable == len(base_lines):
+            break
+        merged.append(base_lines[stable])
+        line += 1
+        i, j, k = stable + 1, end_j + 1, end_k + 1
+    if merged:
+        chunks.append(u"".join(merged))
+    return MergeResult(chunks)
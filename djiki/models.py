@@ -1,16 +1,37 @@
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from taggit.models import Tag, TaggedItem
 from taggit_autosuggest.managers import TaggableManager
 
+from . import pagecache, utils
+from .storage import image_storage
+
 class Versioned(object):
     def last_revision(self):
-        try:
-            return self.revisions.order_by('-created')[0]
-        except IndexError:
-            return None
+        if not hasattr(self, '_last_revision'):
+            if self.current_revision_id:
+                self._last_revision = self.current_revision
+            elif self.pk:
+                # history saved before the pointer was introduced
+                try:
+                    self._last_revision = self.revisions.order_by('-created')[0]
+                except IndexError:
+                    self._last_revision = None
+            else:
+                self._last_revision = None
+        return self._last_revision
+
+    def set_last_revision(self, revision, **fields):
+        fields['current_revision'] = revision
+        type(self).objects.filter(pk=self.pk).update(**fields)
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
+        self._last_revision = revision
 
     def last_change(self):
         last = self.last_revision()
@@ -37,6 +58,13 @@ class Revision(models.Model):
 class Page(models.Model, Versioned):
     title = models.CharField(_("Title"), max_length=256, unique=True)
     tags = TaggableManager(help_text="Keywords or topics this relates to")
+    current_revision = models.ForeignKey('PageRevision', null=True, blank=True,
+            editable=False, related_name='+', on_delete=models.SET_NULL)
+    # denormalized for the page index, see sql/page.sql
+    initial = models.CharField(_("Initial"), max_length=1, editable=False)
+    modified = models.DateTimeField(_("Modified"), null=True, editable=False, db_index=True)
+    # names of the tags, one per line, shown without querying the tags
+    tag_names = models.TextField(_("Tag names"), blank=True, editable=False)
 
     class Meta:
         ordering = ('title',)
@@ -44,30 +72,294 @@ class Page(models.Model, Versioned):
     def __unicode__(self):
         return self.title
 
+    @staticmethod
+    def get_initial(title):
+        initial = title[:1].upper()
+        return initial if initial.isalpha() else u'#'
+
+    def save(self, *args, **kwargs):
+        self.initial = self.get_initial(self.title)
+        super(Page, self).save(*args, **kwargs)
+
+    def set_last_revision(self, revision):
+        super(Page, self).set_last_revision(revision, modified=revision.created)
+
+    def tag_list(self):
+        return [name for name in self.tag_names.split(u'\n') if name]
+
+
+def keyframe_interval():
+    return getattr(settings, 'DJIKI_REVISION_KEYFRAME_INTERVAL', 0)
+
 
 class PageRevision(Revision):
     page = models.ForeignKey(Page, related_name='revisions')
     content = models.TextField(_("Content"), blank=True)
+    # Non-empty if the content is stored as changes against the next revision
+    delta = models.TextField(blank=True, editable=False)
+    previous = models.ForeignKey('self', null=True, blank=True, editable=False,
+            related_name='+', on_delete=models.SET_NULL)
+    # patch from this revision back to the previous one
+    reverse_patch = models.TextField(blank=True, editable=False)
     current_version = models.BooleanField(default=True)
+    rendered_content = models.TextField(_("Rendered content"), blank=True, editable=False)
+    rendered_version = models.CharField(max_length=64, blank=True, editable=False)
+    # when a page or image it refers to was last created or changed
+    links_changed = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __unicode__(self):
         return u"%s: %s" % (self.page, self.description)
 
     def save(self, *args, **kwargs):
-        PageRevision.objects.filter(page=self.page).update(
-                current_version=False)
-        self.current_version = True
-        super(PageRevision, self).save(*args, **kwargs)
+        with transaction.commit_on_success():
+            previous = None
+            if not self.pk:
+                # overlapping saves of the page wait here for each other, and
+                # the pointer is read again under the lock
+                self.page.current_revision_id = Page.objects.select_for_update()\
+                        .filter(pk=self.page_id).values_list('current_revision', flat=True)[0]
+                for name in ('_last_revision', Page.current_revision.cache_name):
+                    self.page.__dict__.pop(name, None)
+                previous = self.page.last_revision()
+            older = PageRevision.objects.filter(page=self.page_id, current_version=True)
+            if self.pk:
+                older = older.exclude(pk=self.pk)
+            older.update(current_version=False)
+            self.current_version = True
+            self.delta = ''
+            if not self.pk:
+                self.set_previous(previous)
+            super(PageRevision, self).save(*args, **kwargs)
+            self.page.set_last_revision(self)
+            if previous and keyframe_interval():
+                previous.compress(self.content)
+        # once committed, so that no other process caches the old pointer or
+        # the old page again
+        invalidate_titles(Page)
+        pagecache.purge(pagecache.page_group(self.page.title), pagecache.LISTS)
+        from .rendering import background_render, schedule
+        if background_render() and render_on_save():
+            schedule(self)
+
+    def set_previous(self, previous):
+        """
+        Points to the previous revision, and stores the patch from this one
+        back to it.
+        """
+        from .diffs import make_reverse_patch
+        self.previous = previous
+        self.reverse_patch = make_reverse_patch(previous.content if previous else u'',
+                self.content)
+
+    def undo_patch(self):
+        """
+        Returns the patch undoing this revision, and the pk of the previous
+        revision.
+        """
+        if self.previous_id or self.reverse_patch or not self.pk:
+            return self.reverse_patch, self.previous_id
+        # saved before the patches were introduced, and not reindexed yet
+        try:
+            previous = PageRevision.objects.filter(page=self.page_id, created__lt=self.created)\
+                    .order_by('-created')[0]
+        except IndexError:
+            previous = None
+        self.set_previous(previous)
+        return self.reverse_patch, self.previous_id
+
+    def compress(self, next_content):
+        """
+        Stores the content as changes against the content of the next
+        revision, unless this revision is a keyframe.
+        """
+        interval = keyframe_interval()
+        position = PageRevision.objects.filter(page=self.page_id, created__lt=self.created).count()
+        if position % interval:
+            PageRevision.objects.filter(pk=self.pk).update(
+                    content='', delta=utils.make_delta(next_content, self.content))
+
+    def expand(self):
+        """
+        Restores the content from the chain of changes leading back from the
+        nearest revision stored in full.
+        """
+        deltas = [self.delta]
+        newer = PageRevision.objects.filter(page=self.page_id, created__gt=self.created)\
+                .order_by('created').values_list('content', 'delta')
+        for content, delta in newer.iterator():
+            if not delta:
+                break
+            deltas.append(delta)
+        for delta in reversed(deltas):
+            content = utils.apply_delta(content, delta)
+        self.content = content
+
+    def render(self):
+        """
+        Returns the HTML of this revision, rendering and storing it first if
+        there is no output of the current parser version yet.
+        """
+        from .parser import render, render_version
+        version = render_version()
+        if self.rendered_version != version:
+            self.rendered_content = render(self.content).decode('utf-8')
+            self.rendered_version = version
+            if self.pk:
+                PageRevision.objects.filter(pk=self.pk).update(
+                        rendered_content=self.rendered_content,
+                        rendered_version=version)
+        return self.rendered_content
+
+class PageLink(models.Model):
+    PAGE = 'page'
+    IMAGE = 'image'
+    KIND_CHOICES = (
+        (PAGE, _("Page")),
+        (IMAGE, _("Image")),
+    )
+
+    page = models.ForeignKey(Page, related_name='links')
+    kind = models.CharField(_("Kind"), max_length=8, choices=KIND_CHOICES)
+    target = models.CharField(_("Target"), max_length=256, db_index=True)
+
+    class Meta:
+        unique_together = (('page', 'kind', 'target'),)
+
+    def __unicode__(self):
+        return u"%s -> %s" % (self.page, self.target)
+
+def update_links(revision):
+    from .parser import extract_links
+    pages, images = extract_links(revision.content)
+    PageLink.objects.filter(page=revision.page_id).delete()
+    PageLink.objects.bulk_create(
+            [PageLink(page_id=revision.page_id, kind=PageLink.PAGE, target=t) for t in pages] +
+            [PageLink(page_id=revision.page_id, kind=PageLink.IMAGE, target=t) for t in images])
 
-def invalidate_content(sender, instance=None, **kwargs):
-    # TODO: This doesn't look implemented
-    instance.page.rendered_content = ''
-    instance.page.save()
-models.signals.post_save.connect(invalidate_content, sender=PageRevision)
+class TagCount(models.Model):
+    tag = models.OneToOneField(Tag, primary_key=True, related_name='djiki_count')
+    count = models.PositiveIntegerField(_("Count"), default=0)
+
+    def __unicode__(self):
+        return u"%s: %d" % (self.tag_id, self.count)
+
+class SearchTerm(models.Model):
+    page = models.ForeignKey(Page, related_name='search_terms')
+    term = models.CharField(_("Term"), max_length=64, db_index=True)
+    weight = models.PositiveIntegerField(_("Weight"))
+
+    class Meta:
+        unique_together = (('term', 'page'),)
+
+def invalidate_titles(model):
+    from .resolver import get_resolver
+    get_resolver(model).invalidate()
+
+def invalidate_resolved_titles(sender, instance=None, raw=False, **kwargs):
+    if not raw:
+        invalidate_titles(sender)
+
+INDEX_KEY = 'djiki-page-index'
+
+def get_page_index():
+    """
+    Returns the initials of the page titles with the number of pages for
+    each, computed with a single indexed query and cached until a page is
+    added or deleted.
+    """
+    index = cache.get(INDEX_KEY)
+    if index is None:
+        index = list(Page.objects.order_by('initial').values_list('initial')\
+                .annotate(count=models.Count('pk')))
+        cache.set(INDEX_KEY, index, 60 * 60 * 24)
+    return index
+
+def invalidate_page_index(sender, instance=None, created=True, raw=False, **kwargs):
+    if created:
+        cache.delete(INDEX_KEY)
+
+def invalidate_backlinks(kind, target):
+    # the HTML of all revisions of the linking pages depends on the target
+    changed = PageRevision.objects.filter(page__links__kind=kind, page__links__target=target)\
+            .update(rendered_version='', links_changed=timezone.now())
+    if changed:
+        # the resolved pages carry the time, used by the HTTP validators
+        invalidate_titles(Page)
+    if pagecache.get_backend():
+        pagecache.purge(*[pagecache.page_group(title) for title in Page.objects\
+                .filter(links__kind=kind, links__target=target).values_list('title', flat=True)])
+
+def render_on_save():
+    return getattr(settings, 'DJIKI_RENDER_ON_SAVE', True)
+
+def render_content(sender, instance=None, raw=False, **kwargs):
+    from .rendering import background_render
+    # otherwise it is queued once saved
+    if not raw and render_on_save() and not background_render():
+        instance.render()
+models.signals.post_save.connect(render_content, sender=PageRevision)
+
+def expand_content(sender, instance=None, **kwargs):
+    # querysets with deferred fields make instances of a generated subclass,
+    # whose signals have that class as sender; deferred fields are missing
+    # from __dict__
+    if isinstance(instance, PageRevision) and instance.__dict__.get('delta'):
+        instance.expand()
+models.signals.post_init.connect(expand_content)
+
+def store_links(sender, instance=None, raw=False, **kwargs):
+    if not raw and instance.current_version:
+        update_links(instance)
+models.signals.post_save.connect(store_links, sender=PageRevision)
+
+def update_search_index(sender, instance=None, raw=False, **kwargs):
+    from .search import get_backend
+    if not raw and instance.current_version:
+        get_backend().update(instance.page, instance.content)
+models.signals.post_save.connect(update_search_index, sender=PageRevision)
+
+def invalidate_page_references(sender, instance=None, created=False, raw=False, **kwargs):
+    # links to the page are no longer rendered as missing
+    if created and not raw:
+        invalidate_backlinks(PageLink.PAGE, instance.title)
+models.signals.post_save.connect(invalidate_page_references, sender=Page)
+
+def invalidate_deleted_page_references(sender, instance=None, **kwargs):
+    # links to the page are rendered as missing again
+    invalidate_backlinks(PageLink.PAGE, instance.title)
+models.signals.post_delete.connect(invalidate_deleted_page_references, sender=Page)
+
+def remove_from_search_index(sender, instance=None, **kwargs):
+    from .search import get_backend
+    get_backend().remove(instance.pk)
+models.signals.post_delete.connect(remove_from_search_index, sender=Page)
+models.signals.post_save.connect(invalidate_resolved_titles, sender=Page)
+models.signals.post_save.connect(invalidate_page_index, sender=Page)
+models.signals.post_delete.connect(invalidate_page_index, sender=Page)
+
+def uncount_tags(sender, instance=None, **kwargs):
+    from .tags import update_counts
+    update_counts(removed=instance.tag_list())
+models.signals.pre_delete.connect(uncount_tags, sender=Page)
+models.signals.post_delete.connect(invalidate_resolved_titles, sender=Page)
+
+def purge_page(sender, instance=None, **kwargs):
+    pagecache.purge(pagecache.page_group(instance.title), pagecache.LISTS)
+models.signals.post_delete.connect(purge_page, sender=Page)
+
+def purge_tagged_page(sender, instance=None, raw=False, **kwargs):
+    if not raw and pagecache.get_backend():
+        titles = Page.objects.filter(pk=instance.object_id).values_list('title', flat=True) \
+                if instance.content_type.model_class() is Page else []
+        pagecache.purge(pagecache.LISTS, *[pagecache.page_group(title) for title in titles])
+models.signals.post_save.connect(purge_tagged_page, sender=TaggedItem)
+models.signals.post_delete.connect(purge_tagged_page, sender=TaggedItem)
 
 
 class Image(models.Model, Versioned):
     name = models.CharField(_("Name"), max_length=128, unique=True)
+    current_revision = models.ForeignKey('ImageRevision', null=True, blank=True,
+            editable=False, related_name='+', on_delete=models.SET_NULL)
 
     class Meta:
         ordering = ('name',)
@@ -78,4 +370,22 @@ class Image(models.Model, Versioned):
 
 class ImageRevision(Revision):
     image = models.ForeignKey(Image, related_name='revisions')
-    file = models.FileField(_("File"), upload_to=settings.DJIKI_IMAGES_PATH)
+    file = models.FileField(_("File"), upload_to=settings.DJIKI_IMAGES_PATH, storage=image_storage)
+
+    def save(self, *args, **kwargs):
+        with transaction.commit_on_success():
+            super(ImageRevision, self).save(*args, **kwargs)
+            self.image.set_last_revision(self)
+        # once committed, so that no other process caches the old image again;
+        # the rendered HTML embeds thumbnails of the latest image revision
+        invalidate_titles(Image)
+        invalidate_backlinks(PageLink.IMAGE, self.image.name)
+        pagecache.purge(pagecache.image_group(self.image.name), pagecache.LISTS)
+
+def prepare_thumbnails(sender, instance=None, raw=False, created=False, **kwargs):
+    from .thumbnails import schedule
+    if not raw and created:
+        schedule(instance.file.name, image_name=instance.image.name)
+models.signals.post_save.connect(prepare_thumbnails, sender=ImageRevision)
+models.signals.post_save.connect(invalidate_resolved_titles, sender=Image)
+models.signals.post_delete.connect(invalidate_resolved_titles, sender=Image)
@@ -0,0 +1,91 @@
+from functools import wraps
+from hashlib import md5
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import get_cache
+
+# group of the views listing pages
+LISTS = 'lists'
+
+_backends = {}
+
+def cache_alias():
+    return getattr(settings, 'DJIKI_PAGE_CACHE', None)
+
+def cache_timeout():
+    return getattr(settings, 'DJIKI_PAGE_CACHE_TIMEOUT', 60 * 60)
+
+def get_backend():
+    alias = cache_alias()
+    if alias and alias not in _backends:
+        _backends[alias] = get_cache(alias)
+    return _backends.get(alias)
+
+def page_group(title):
+    return u'page:%s' % title
+
+def image_group(name):
+    return u'image:%s' % name
+
+def _generation_key(group):
+    return 'djiki-page-cache-generation:%s' % md5(group.encode('utf-8')).hexdigest()
+
+def purge(*groups):
+    """
+    Discards the cached responses of the given groups.
+    """
+    backend = get_backend()
+    if backend and groups:
+        backend.delete_many([_generation_key(group) for group in groups])
+
+def _entry_key(backend, group, request):
+    from .parser import render_version
+    generation_key = _generation_key(group)
+    generation = backend.get(generation_key)
+    if generation is None:
+        generation = uuid4().hex
+        backend.set(generation_key, generation)
+    path = request.get_full_path()
+    return 'djiki-page-cache:%s:%s:%s' % (render_version(), generation,
+            md5(path.encode('utf-8')).hexdigest())
+
+def pending_messages(request):
+    """
+    Tells whether messages are waiting to be shown, which a cached response
+    would leave out.
+    """
+    return 'messages' in request.COOKIES
+
+def _cacheable(request):
+    return request.method in ('GET', 'HEAD') and not request.user.is_authenticated() \
+            and not pending_messages(request)
+
+def cache_anonymous(group):
+    """
+    Caches the responses of the view to anonymous readers in the cache
+    named by DJIKI_PAGE_CACHE, until the group they belong to is purged.
+    `group` is the name of the group, or a function of the arguments of the
+    view returning it, or None for responses which must not be cached.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            backend = get_backend()
+            name = group(request, *args, **kwargs) if callable(group) else group
+            if not backend or name is None or not _cacheable(request):
+                return view(request, *args, **kwargs)
+            key = _entry_key(backend, name, request)
+            response = backend.get(key)
+            if response is not None:
+                return response
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.cookies \
+                    and 'no-store' not in response.get('Cache-Control', ''):
+                store = lambda r: backend.set(key, r, cache_timeout())
+                if hasattr(response, 'render') and callable(response.render):
+                    response.add_post_render_callback(store)
+                else:
+                    store(response)
+            return response
+        return wrapper
+    return decorator
@@ -1,14 +1,115 @@
 import re
-from creole import Parser
+from hashlib import md5
+from uuid import uuid4
+from creole import Parser, DocNode
 from creole.html_emitter import HtmlEmitter
+from creole.rules import LinkRules
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 
-from . import models, utils
+from . import models, resolver, thumbnails, utils
+from .timing import timed
+
+# Bump whenever a change to the emitter or its templates alters the output,
+# so that HTML stored with the revisions gets rendered again.
+PARSER_VERSION = 2
+
+def render_version():
+    return u'%d:%s' % (PARSER_VERSION, getattr(settings, 'DJIKI_RENDER_VERSION', ''))
+
+def section_cache_timeout():
+    return getattr(settings, 'DJIKI_SECTION_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# size of the thumbnails of images embedded without one
+DEFAULT_IMAGE_SIZE = '912x912'
+
+GENERATION_KEY = 'djiki-section-generation'
+
+def invalidate_sections():
+    """
+    Discards all cached sections. They are checked against the pages and
+    images they refer to, so this is only needed when their HTML changes
+    for another reason, such as edited templates.
+    """
+    generation = uuid4().hex
+    cache.set(GENERATION_KEY, generation, section_cache_timeout())
+    return generation
+
+def split_sections(src, paragraphs=False):
+    """
+    Splits the source before each header, leaving alone the preformatted
+    blocks. As a header ends any block, the sections can be rendered
+    separately. With `paragraphs`, the source is also split after blank
+    lines, which end any block as well.
+    """
+    sections, current, pre = [], [], False
+    for line in src.splitlines(True):
+        if pre:
+            pre = not (line.startswith('}}}') and not line[3:].strip())
+        elif line.startswith('{{{') and not line[3:].strip():
+            pre = True
+        elif line.lstrip().startswith('=') and current:
+            sections.append(u''.join(current))
+            current = []
+        elif paragraphs and not line.strip():
+            current.append(line)
+            sections.append(u''.join(current))
+            current = []
+            continue
+        current.append(line)
+    sections.append(u''.join(current))
+    return sections
+
+def get_targets(root, link_rules):
+    """
+    Walks the document tree and returns the sets of internal page titles
+    and image names it refers to.
+    """
+    pages, images = set(), set()
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.children)
+        if node.kind not in ('link', 'image') or link_rules.addr_re.match(node.content):
+            continue
+        if node.kind == 'link':
+            pages.add(utils.deurlize_title(node.content))
+        else:
+            images.add(utils.deurlize_title(node.content))
+    return pages, images
+
 
 class DjikiHtmlEmitter(HtmlEmitter):
     image_params_re = re.compile(r'^(?:(?P<size>[0-9]+x[0-9]+)(?:\||$))?(?P<title>.*)$')
 
+    def __init__(self, *args, **kwargs):
+        super(DjikiHtmlEmitter, self).__init__(*args, **kwargs)
+        self.pages = set()
+        self.images = {}
+
+    def resolve_targets(self):
+        pages, images = get_targets(self.root, self.link_rules)
+        self.set_targets(resolver.pages.resolve_many(pages) if pages else {},
+                resolver.images.resolve_many(images) if images else {})
+
+    def set_targets(self, pages, images):
+        """
+        Takes the linked pages and embedded images, as resolved by the
+        title resolvers.
+        """
+        self.pages = set(title for title, entry in pages.iteritems() if entry)
+        for name, entry in images.iteritems():
+            if entry and entry[1]:
+                pk, revision_pk, file = entry
+                image = models.Image(pk=pk, name=name, current_revision_id=revision_pk)
+                self.images[name] = models.ImageRevision(pk=revision_pk, image=image, file=file)
+
+    def emit(self):
+        self.resolve_targets()
+        return super(DjikiHtmlEmitter, self).emit()
+
     def header_emit(self, node):
         return u'<a name="%s"></a><h%d>%s</h%d>\n' % (
             utils.anchorize(node.content),
@@ -29,10 +130,15 @@ class DjikiHtmlEmitter(HtmlEmitter):
                     self.attr_escape(target), inside)
             elif m.group('inter_wiki'):
                 raise NotImplementedError
-        return u'<a href="%s">%s</a>' % (
+        if utils.deurlize_title(target) in self.pages:
+            css_class = ''
+        else:
+            css_class = ' class="missing"'
+        return u'<a href="%s"%s>%s</a>' % (
             reverse('djiki-page-view', kwargs={'title': utils.urlize_title(self.attr_escape(target))}),
-            inside)
+            css_class, inside)
 
+    @timed('image')
     def image_emit(self, node):
         target = node.content
         text = self.get_text(node)
@@ -47,14 +153,114 @@ class DjikiHtmlEmitter(HtmlEmitter):
             elif m.group('inter_wiki'):
                 raise NotImplementedError
         else:
-            try:
-                image = models.Image.objects.get(name=utils.deurlize_title(target))
-                ctx['image'] = image
-                ctx['url_name'] = utils.urlize_title(image.name)
-            except models.Image.DoesNotExist:
-                pass
+            revision = self.images.get(utils.deurlize_title(target))
+            if revision:
+                ctx['image'] = revision.image
+                ctx['file'] = revision.file
+                ctx['thumbnail_size'] = ctx.get('size') or DEFAULT_IMAGE_SIZE
+                ctx['url_name'] = utils.urlize_title(revision.image.name)
         return render_to_string('djiki/parser/image.html', ctx)
 
-def render(src):
-    doc = Parser(src).parse()
-    return DjikiHtmlEmitter(doc).emit().encode('utf-8', 'ignore')
+def extract_links(src):
+    return get_targets(Parser(src).parse(), LinkRules())
+
+def get_image_sizes(root, link_rules, default=None):
+    """
+    Walks the document tree and returns a dict mapping the names of
+    internal images to the sizes they are embedded with, `default` standing
+    for images embedded without a size.
+    """
+    sizes = {}
+    nodes = [root]
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.children)
+        if node.kind != 'image' or link_rules.addr_re.match(node.content):
+            continue
+        m = DjikiHtmlEmitter.image_params_re.match(node.children[0].content if node.children else '')
+        size = m and m.group('size') or default
+        if size:
+            sizes.setdefault(utils.deurlize_title(node.content), set()).add(size)
+    return sizes
+
+def extract_image_sizes(src):
+    """
+    Returns a dict mapping the names of internal images to the sizes they
+    are embedded with.
+    """
+    return get_image_sizes(Parser(src).parse(), LinkRules())
+
+def section_state(pages, images, resolved_pages, resolved_images, thumbnails_ready):
+    """
+    Returns what the HTML of a section depends on besides its source: which
+    of the linked pages exist, and which revision of the embedded images is
+    current, with which of its thumbnails are ready.
+    """
+    state = [(title, bool(resolved_pages[title])) for title in sorted(pages)]
+    for name in sorted(images):
+        entry = resolved_images[name]
+        if entry and entry[1]:
+            state.append((name, entry[1], tuple((size, bool(thumbnails_ready.get(
+                    thumbnails.cache_key(entry[2], size)))) for size in sorted(images[name]))))
+        else:
+            state.append((name, None, ()))
+    return tuple(state)
+
+@timed('render')
+def render(src, paragraphs=False):
+    """
+    Renders the source section by section, taking the sections which have
+    not changed since they were last rendered from the cache. Each cached
+    section keeps the pages and images it refers to, and is only used while
+    they are in the same state.
+    """
+    sections = split_sections(src, paragraphs)
+    keys = ['djiki-section:%s:%s' % (render_version(), md5(section.encode('utf-8')).hexdigest())
+            for section in sections]
+    cached = cache.get_many([GENERATION_KEY] + keys)
+    generation = cached.pop(GENERATION_KEY, None) or invalidate_sections()
+    link_rules = LinkRules()
+    docs, targets = {}, {}
+    for key, section in zip(keys, sections):
+        if key in targets:
+            continue
+        entry = cached.get(key)
+        if entry and entry[0] == generation:
+            targets[key] = entry[1:3]
+        else:
+            docs[key] = Parser(section).parse()
+            targets[key] = (get_targets(docs[key], link_rules)[0],
+                    get_image_sizes(docs[key], link_rules, DEFAULT_IMAGE_SIZE))
+    # resolve the targets of all sections together
+    pages = set().union(*[section_pages for section_pages, images in targets.itervalues()])
+    images = {}
+    for section_pages, section_images in targets.itervalues():
+        for name, sizes in section_images.iteritems():
+            images.setdefault(name, set()).update(sizes)
+    resolved_pages = resolver.pages.resolve_many(pages) if pages else {}
+    resolved_images = resolver.images.resolve_many(images) if images else {}
+    thumbnail_keys = [thumbnails.cache_key(entry[2], size) for name, entry in
+            resolved_images.iteritems() if entry and entry[1] for size in images[name]]
+    ready = cache.get_many(thumbnail_keys) if thumbnail_keys else {}
+    html, states = {}, {}
+    for key, (section_pages, section_images) in targets.iteritems():
+        states[key] = section_state(section_pages, section_images, resolved_pages,
+                resolved_images, ready)
+        if key not in docs and cached[key][3] == states[key]:
+            html[key] = cached[key][4]
+    missing = [key for key in targets if key not in html]
+    if missing:
+        for key, section in zip(keys, sections):
+            if key in missing and key not in docs:
+                docs[key] = Parser(section).parse()
+        # emit the changed sections from a common root, with the targets
+        # resolved above
+        root = DocNode('document')
+        root.children = [docs[key] for key in missing]
+        emitter = DjikiHtmlEmitter(root)
+        emitter.set_targets(resolved_pages, resolved_images)
+        rendered = dict((key, emitter.emit_node(docs[key])) for key in missing)
+        cache.set_many(dict((key, (generation,) + targets[key] + (states[key], rendered[key]))
+                for key in missing), section_cache_timeout())
+        html.update(rendered)
+    return u''.join(html[key] for key in keys).encode('utf-8', 'ignore')
@@ -0,0 +1,61 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+from . import models, pagecache, tasks
+from .parser import render_version
+
+def background_render():
+    return getattr(settings, 'DJIKI_BACKGROUND_RENDER', False)
+
+def stale_timeout():
+    return getattr(settings, 'DJIKI_RENDER_STALE_TIMEOUT', 30)
+
+# how long the time a render was queued is remembered
+SCHEDULED_TIMEOUT = 60 * 60 * 24
+
+def _scheduled_key(pk):
+    return 'djiki-render-scheduled:%s:%d' % (render_version(), pk)
+
+def render_revision(pk):
+    """
+    Renders the revision and stores its HTML, unless it is there already.
+    """
+    try:
+        revision = models.PageRevision.objects.select_related('page').get(pk=pk)
+    except models.PageRevision.DoesNotExist:
+        return
+    if revision.rendered_version != render_version():
+        revision.render()
+        pagecache.purge(pagecache.page_group(revision.page.title))
+
+def schedule(revision):
+    """
+    Queues the render of the revision, remembering when it was first queued.
+    """
+    cache.add(_scheduled_key(revision.pk), time.time(), SCHEDULED_TIMEOUT)
+    tasks.submit(('render', revision.pk), render_revision, revision.pk)
+
+def get_html(revision):
+    """
+    Returns the HTML of the revision, and whether it is stale. While the
+    revision is rendered in the background, the HTML it had with an older
+    parser, or else the HTML of the previous revision, is served for up to
+    DJIKI_RENDER_STALE_TIMEOUT seconds, after which the revision is
+    rendered right away.
+    """
+    if revision.rendered_version == render_version() or not background_render() \
+            or not revision.pk or not tasks.get_pool().size:
+        return revision.render(), False
+    html = revision.rendered_content
+    if not html and revision.previous_id:
+        html = models.PageRevision.objects.filter(pk=revision.previous_id)\
+                .values_list('rendered_content', flat=True)[0]
+    if html:
+        scheduled = cache.get(_scheduled_key(revision.pk))
+        if scheduled is None:
+            schedule(revision)
+            scheduled = time.time()
+        if time.time() - scheduled < stale_timeout():
+            return html, True
+    return revision.render(), False
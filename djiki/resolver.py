@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache
+
+from . import models
+
+def cache_size():
+    return getattr(settings, 'DJIKI_RESOLVER_CACHE_SIZE', 1000)
+
+
+class TitleResolver(object):
+    """
+    Maps titles to a few columns of the pages or images of that title, or to
+    None for titles nobody has used yet, keeping the recently used existing
+    ones in memory. Missing titles are looked up every time, as they may be
+    created by any process. Any change of the model discards the entries of
+    all processes, through a generation stamp kept in the shared cache.
+    """
+
+    def __init__(self, model, field, columns):
+        self.model = model
+        self.field = field
+        self.columns = columns
+        self.key = 'djiki-resolver:%s' % model._meta.object_name.lower()
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        generation = uuid4().hex
+        cache.set(self.key, generation)
+        with self.lock:
+            self.entries.clear()
+            self.generation = generation
+        return generation
+
+    def resolve_many(self, titles):
+        generation = cache.get(self.key) or self.invalidate()
+        found, missing = {}, []
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            for title in titles:
+                if title in self.entries:
+                    # move to the end, as the most recently used
+                    found[title] = self.entries[title] = self.entries.pop(title)
+                else:
+                    missing.append(title)
+        if missing:
+            fetched = dict.fromkeys(missing)
+            rows = self.model.objects.filter(**{'%s__in' % self.field: missing})\
+                    .values_list(self.field, *self.columns)
+            for row in rows:
+                fetched[row[0]] = row[1:]
+            found.update(fetched)
+            with self.lock:
+                if generation == self.generation:
+                    self.entries.update((title, entry) for title, entry in fetched.iteritems()
+                            if entry is not None)
+                    while len(self.entries) > cache_size():
+                        self.entries.popitem(last=False)
+        return found
+
+    def resolve(self, title):
+        return self.resolve_many([title])[title]
+
+pages = TitleResolver(models.Page, 'title',
+        ('pk', 'current_revision', 'current_revision__created',
+            'current_revision__links_changed'))
+images = TitleResolver(models.Image, 'name',
+        ('pk', 'current_revision', 'current_revision__file'))
+
+def get_resolver(model):
+    return {models.Page: pages, models.Image: images}[model]
@@ -0,0 +1,231 @@
+import re
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Count, Sum
+from django.utils.importlib import import_module
+
+from . import models, utils
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+def get_words(text):
+    return [w.lower() for w in word_re.findall(text)]
+
+def get_terms(query_string):
+    terms = []
+    for term in utils.normalize_query(query_string):
+        for word in get_words(term):
+            if word not in terms:
+                terms.append(word)
+    return terms
+
+
+class BaseBackend(object):
+    """
+    Keeps the full text index of the latest page revisions. Subclasses
+    have to implement `update`, `remove`, `count` and `search`.
+    """
+    def setup(self):
+        pass
+
+    def update(self, page, content):
+        raise NotImplementedError
+
+    def remove(self, page_id):
+        raise NotImplementedError
+
+    def count(self, query_string):
+        raise NotImplementedError
+
+    def search(self, query_string, offset, limit):
+        """Returns ids of the matching pages, the best matches first."""
+        raise NotImplementedError
+
+
+class SimpleBackend(BaseBackend):
+    """
+    An inverted index kept in a regular table, usable on every database.
+    Matches pages containing all the query words, ranked by the number of
+    occurrences, with the words in the title counting more.
+    """
+    title_weight = 10
+
+    def update(self, page, content):
+        weights = defaultdict(int)
+        for word in get_words(page.title):
+            weights[word] += self.title_weight
+        for word in get_words(content):
+            weights[word] += 1
+        self.remove(page.pk)
+        models.SearchTerm.objects.bulk_create([
+                models.SearchTerm(page_id=page.pk, term=term[:64], weight=weight)
+                for term, weight in weights.iteritems()])
+
+    def remove(self, page_id):
+        models.SearchTerm.objects.filter(page=page_id).delete()
+
+    def _matches(self, query_string):
+        terms = [t[:64] for t in get_terms(query_string)]
+        return models.SearchTerm.objects.filter(term__in=terms).values('page')\
+                .annotate(matched=Count('term'), score=Sum('weight'))\
+                .filter(matched=len(terms))
+
+    def count(self, query_string):
+        return self._matches(query_string).count()
+
+    def search(self, query_string, offset, limit):
+        matches = self._matches(query_string).order_by('-score', 'page')
+        return [m['page'] for m in matches[offset:offset + limit]]
+
+
+class SqliteBackend(BaseBackend):
+    """Uses an FTS5 virtual table, ranked by BM25."""
+    table = 'djiki_search_fts'
+
+    def setup(self):
+        if self.table not in connection.introspection.table_names():
+            connection.cursor().execute("CREATE VIRTUAL TABLE %s "
+                    "USING fts5(title, content, tokenize='unicode61')" % self.table)
+            transaction.commit_unless_managed()
+
+    def _match(self, query_string):
+        return u' '.join(u'"%s"' % t.replace('"', '""')
+                for t in utils.normalize_query(query_string))
+
+    def update(self, page, content):
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE rowid = %%s" % self.table, [page.pk])
+        cursor.execute("INSERT INTO %s (rowid, title, content) VALUES (%%s, %%s, %%s)" % self.table,
+                [page.pk, page.title, content])
+        transaction.commit_unless_managed()
+
+    def remove(self, page_id):
+        connection.cursor().execute("DELETE FROM %s WHERE rowid = %%s" % self.table, [page_id])
+        transaction.commit_unless_managed()
+
+    def count(self, query_string):
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM %s WHERE %s MATCH %%s" % (self.table, self.table),
+                [self._match(query_string)])
+        return cursor.fetchone()[0]
+
+    def search(self, query_string, offset, limit):
+        cursor = connection.cursor()
+        cursor.execute("SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY bm25(%s, 10.0, 1.0) "
+                "LIMIT %%s OFFSET %%s" % (self.table, self.table, self.table),
+                [self._match(query_string), limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresBackend(BaseBackend):
+    """Uses a tsvector column with a GIN index, ranked by ts_rank."""
+    table = 'djiki_search_document'
+
+    def __init__(self):
+        self.config = getattr(settings, 'DJIKI_SEARCH_CONFIG', 'english')
+
+    def setup(self):
+        if self.table not in connection.introspection.table_names():
+            cursor = connection.cursor()
+            cursor.execute("CREATE TABLE %s ("
+                    "page_id integer PRIMARY KEY, document tsvector NOT NULL)" % self.table)
+            cursor.execute("CREATE INDEX %s_document ON %s USING gin(document)" % (
+                    self.table, self.table))
+            transaction.commit_unless_managed()
+
+    def update(self, page, content):
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE page_id = %%s" % self.table, [page.pk])
+        cursor.execute("INSERT INTO %s (page_id, document) VALUES (%%s, "
+                "setweight(to_tsvector(%%s, %%s), 'A') || setweight(to_tsvector(%%s, %%s), 'B'))" % self.table,
+                [page.pk, self.config, page.title, self.config, content])
+        transaction.commit_unless_managed()
+
+    def remove(self, page_id):
+        connection.cursor().execute("DELETE FROM %s WHERE page_id = %%s" % self.table, [page_id])
+        transaction.commit_unless_managed()
+
+    def count(self, query_string):
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM %s WHERE document @@ plainto_tsquery(%%s, %%s)" % self.table,
+                [self.config, query_string])
+        return cursor.fetchone()[0]
+
+    def search(self, query_string, offset, limit):
+        cursor = connection.cursor()
+        cursor.execute("SELECT page_id FROM %s, plainto_tsquery(%%s, %%s) query "
+                "WHERE document @@ query ORDER BY ts_rank(document, query) DESC, page_id "
+                "LIMIT %%s OFFSET %%s" % self.table,
+                [self.config, query_string, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_backend_class():
+    path = getattr(settings, 'DJIKI_SEARCH_BACKEND', None)
+    if path:
+        module, cls = path.rsplit('.', 1)
+        return getattr(import_module(module), cls)
+    if connection.vendor == 'postgresql':
+        return PostgresBackend
+    if connection.vendor == 'sqlite':
+        return SqliteBackend
+    return SimpleBackend
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        cls = get_backend_class()
+        # the tables are created by the custom SQL of SearchTerm on syncdb, or
+        # by the djiki_reindex command; until then the simple index is used
+        table = getattr(cls, 'table', None)
+        if table and table not in connection.introspection.table_names():
+            cls = SimpleBackend
+        _backend = cls()
+    return _backend
+
+def setup_backend():
+    global _backend
+    _backend = get_backend_class()()
+    try:
+        _backend.setup()
+    except DatabaseError:
+        # e.g. SQLite compiled without FTS5
+        transaction.rollback_unless_managed()
+        _backend = SimpleBackend()
+    return _backend
+
+
+class SearchResults(object):
+    """
+    A lazy, sliceable sequence of the pages matching the query, suitable
+    for Django's Paginator.
+    """
+    def __init__(self, query_string, backend=None):
+        self.query_string = query_string
+        self.backend = backend or get_backend()
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if get_terms(self.query_string):
+                self._count = self.backend.count(self.query_string)
+            else:
+                self._count = 0
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        if not self.count():
+            return []
+        offset = k.start or 0
+        limit = (k.stop if k.stop is not None else self.count()) - offset
+        ids = self.backend.search(self.query_string, offset, limit)
+        pages = models.Page.objects.in_bulk(ids)
+        return [pages[pk] for pk in ids if pk in pages]
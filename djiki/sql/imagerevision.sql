@@ -0,0 +1 @@
+CREATE INDEX djiki_imagerevision_image_created ON djiki_imagerevision (image_id, created, id);
@@ -0,0 +1 @@
+CREATE INDEX djiki_page_initial_title ON djiki_page (initial, title);
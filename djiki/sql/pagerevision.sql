@@ -0,0 +1,2 @@
+CREATE INDEX djiki_pagerevision_page_created ON djiki_pagerevision (page_id, created, id);
+CREATE INDEX djiki_pagerevision_current_created ON djiki_pagerevision (current_version, created, id);
@@ -0,0 +1,2 @@
+CREATE TABLE djiki_search_document (page_id integer PRIMARY KEY, document tsvector NOT NULL);
+CREATE INDEX djiki_search_document_document ON djiki_search_document USING gin(document);
@@ -0,0 +1 @@
+CREATE VIRTUAL TABLE djiki_search_fts USING fts5(title, content, tokenize='unicode61');
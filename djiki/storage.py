@@ -0,0 +1,61 @@
+import hashlib
+import os
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """
+    Streams uploads to temporary files, computing their SHA-1 digest on the
+    way, so that the content need not be read again to store it.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        self.sha1 = hashlib.sha1()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha1.update(raw_data)
+        return super(HashingUploadHandler, self).receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super(HashingUploadHandler, self).file_complete(file_size)
+        file.sha1 = self.sha1.hexdigest()
+        return file
+
+
+def content_hash(content):
+    # the field passes itself, wrapping the uploaded file
+    for f in (content, getattr(content, 'file', None)):
+        digest = getattr(f, 'sha1', None)
+        if digest:
+            return digest
+    sha1 = hashlib.sha1()
+    for chunk in content.chunks():
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores files under the digest of their content, keeping the directory
+    and extension of the given name. Files of the same content are stored
+    only once.
+    """
+
+    def hashed_name(self, name, content):
+        directory, filename = os.path.split(name)
+        digest = content_hash(content)
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(directory, digest[:2], digest[2:4], digest + extension)
+
+    def save(self, name, content):
+        if name is None:
+            name = content.name
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            content.close()
+            return name
+        return super(ContentAddressedStorage, self).save(name, content)
+
+image_storage = ContentAddressedStorage()
@@ -0,0 +1,88 @@
+import math
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import Count, F
+
+from taggit.models import Tag, TaggedItem
+
+from . import models
+
+CLOUD_KEY = 'djiki-tag-cloud'
+CLOUD_TIMEOUT = 60 * 60 * 24
+
+# number of the font sizes used by the tag cloud
+CLOUD_WEIGHTS = 5
+
+def update_counts(added=(), removed=()):
+    """
+    Adjusts the numbers of pages of the tags added to or removed from a page.
+    """
+    names = set(added) | set(removed)
+    if not names:
+        return
+    tags = dict(Tag.objects.filter(name__in=names).values_list('name', 'pk'))
+    added = [tags[name] for name in added if name in tags]
+    removed = [tags[name] for name in removed if name in tags]
+    if added:
+        existing = set(models.TagCount.objects.filter(tag__in=added).values_list('tag', flat=True))
+        models.TagCount.objects.bulk_create(
+                [models.TagCount(tag_id=pk) for pk in added if pk not in existing])
+        models.TagCount.objects.filter(tag__in=added).update(count=F('count') + 1)
+    if removed:
+        models.TagCount.objects.filter(tag__in=removed, count__gt=0).update(count=F('count') - 1)
+    cache.delete(CLOUD_KEY)
+
+def set_tags(page, names):
+    """
+    Sets the tags of the page, along with its tag names and the tag counts.
+    """
+    names = sorted(set(names))
+    old = set(page.tag_list())
+    page.tags.set(*names)
+    page.tag_names = u'\n'.join(names)
+    models.Page.objects.filter(pk=page.pk).update(tag_names=page.tag_names)
+    update_counts(set(names) - old, old - set(names))
+
+def recount():
+    """
+    Rebuilds the tag names of all pages and the tag counts from the tags.
+    """
+    items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(models.Page))
+    names = {}
+    for page, name in items.order_by('tag__name').values_list('object_id', 'tag__name').iterator():
+        names.setdefault(page, []).append(name)
+    for page, tag_names in models.Page.objects.values_list('pk', 'tag_names').iterator():
+        new_names = u'\n'.join(names.get(page, []))
+        if new_names != tag_names:
+            models.Page.objects.filter(pk=page).update(tag_names=new_names)
+    models.TagCount.objects.all().delete()
+    models.TagCount.objects.bulk_create([models.TagCount(tag_id=tag, count=count)
+            for tag, count in items.values_list('tag').annotate(count=Count('pk')).order_by()])
+    cache.delete(CLOUD_KEY)
+
+def get_cloud():
+    """
+    Returns the used tags in alphabetical order, with the number of pages
+    and a weight from 1 to CLOUD_WEIGHTS growing with it.
+    """
+    cloud = cache.get(CLOUD_KEY)
+    if cloud is None:
+        cloud = [{'name': name, 'count': count} for name, count in models.TagCount.objects\
+                .filter(count__gt=0).order_by('tag__name').values_list('tag__name', 'count')]
+        if cloud:
+            top = math.log(max(tag['count'] for tag in cloud) + 1)
+            for tag in cloud:
+                tag['weight'] = 1 + int(math.log(tag['count'] + 1) / top * (CLOUD_WEIGHTS - 1))
+        cache.set(CLOUD_KEY, cloud, CLOUD_TIMEOUT)
+    return cloud
+
+def tagged_pages(names):
+    """
+    Returns the pages having all the given tags, found by a single grouped
+    query on the tagged items.
+    """
+    names = set(names)
+    items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(models.Page),
+            tag__name__in=names).values('object_id').annotate(tags=Count('tag'))\
+            .filter(tags=len(names)).order_by()
+    return models.Page.objects.filter(pk__in=items.values('object_id'))
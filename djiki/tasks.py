@@ -0,0 +1,89 @@
+import logging
+import threading
+from Queue import Queue
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger('djiki.tasks')
+
+def worker_threads():
+    return getattr(settings, 'DJIKI_WORKER_THREADS', 2)
+
+
+class WorkerPool(object):
+    """
+    Runs tasks in a few daemon threads of the current process. Without
+    threads, tasks are run right away in the calling one.
+    """
+
+    def __init__(self, size=None):
+        self._size = size
+        self.queue = Queue()
+        self.pending = set()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return worker_threads() if self._size is None else self._size
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queues the call, unless a task with the same key is still waiting.
+        Returns whether the task was queued.
+        """
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        if not self.size:
+            self.run(key, func, args, kwargs)
+            return True
+        self.start()
+        self.queue.put((key, func, args, kwargs))
+        return True
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work,
+                        name='djiki-worker-%d' % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self, key, func, args, kwargs):
+        # a task submitted while this one runs may see newer data
+        with self.lock:
+            self.pending.discard(key)
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Task %r failed", key)
+
+    def work(self):
+        while True:
+            key, func, args, kwargs = self.queue.get()
+            try:
+                self.run(key, func, args, kwargs)
+            finally:
+                # every thread has a connection of its own
+                connection.close()
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Waits until all queued tasks are done.
+        """
+        self.queue.join()
+
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool()
+    return _pool
+
+def submit(key, func, *args, **kwargs):
+    return get_pool().submit(key, func, *args, **kwargs)
@@ -1,7 +1,7 @@
-from diff_match_patch import diff_match_patch
 from django import template
 from django.utils.safestring import mark_safe
-from .. import parser, utils
+from .. import diffs, parser, thumbnails, utils
+from ..timing import timed
 
 register = template.Library()
 
@@ -10,18 +10,24 @@ def djiki_markup(txt):
 	return mark_safe(parser.render(txt))
 
 @register.filter
-def html_diff(diff):
-	html = []
-	for (op, data) in diff:
-		text = (data.replace("&", "&amp;").replace("<", "&lt;")\
-				.replace(">", "&gt;").replace("\n", "&para;<br />"),)
-		if op == diff_match_patch.DIFF_INSERT:
-			html.append("<span class=\"added\">%s</span>" % text)
-		elif op == diff_match_patch.DIFF_DELETE:
-			html.append("<span class=\"removed\">%s</del>" % text)
-		elif op == diff_match_patch.DIFF_EQUAL:
-			html.append("<span>%s</span>" % text)
-	return mark_safe("".join(html))
+def html_diff(diff, context=None):
+	if context is not None:
+		context = int(context)
+	return mark_safe(diffs.render_html(diff, context))
+
+@register.assignment_tag
+def djiki_thumbnail(file, size, image_name=None):
+	"""
+	Returns the thumbnail if it has been made already, otherwise queues it
+	and returns None, so that a placeholder can be shown.
+	"""
+	if not file:
+		return None
+	with timed('thumbnail'):
+		thumbnail = thumbnails.get_ready(file.name, size)
+		if thumbnail is None:
+			thumbnails.schedule(file.name, [size], image_name)
+	return thumbnail or None
 
 @register.filter
 def urlize_title(title):
@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import shutil
+import sys
+import tempfile
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from StringIO import StringIO
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import signals
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.test.client import Client
-from . import models
+from . import benchmark, diffs, merge, models, pagecache, parser, resolver, search, tags, tasks, thumbnails, timing
+from .storage import image_storage
 
 content1 = u"""
 = Hello world! =
@@ -34,6 +46,11 @@ description3 = u"Added some text"
 class SimpleTest(TestCase):
 	def setUp(self):
 		settings.DJIKI_SPACES_AS_UNDERSCORES = False
+		# the rolled back pages of other tests may still be remembered, and
+		# their reused primary keys may still key cached diffs
+		cache.clear()
+		resolver.pages.invalidate()
+		resolver.images.invalidate()
 		settings.DJIKI_ALLOW_ANONYMOUS_EDITS = True
 		self.user1 = User.objects.create(username='foouser')
 		self.password1 = 'foopassword'
@@ -102,6 +119,142 @@ class SimpleTest(TestCase):
 			print r.content
 		self.assertEqual(r.status_code, 302)
 
+	def test_edit_conflict(self):
+		title = u"Conflict page"
+		base = u"".join(u"Line %d of the page\n" % i for i in range(10))
+		self._page_edit(title, base)
+		first_revision = models.Page.objects.get(title=title).last_revision()
+		self._page_edit(title, base.replace(u"Line 2 ", u"Line two ")\
+				.replace(u"7 of the", u"7 of this"))
+		client = Client()
+		url = reverse('djiki-page-edit', kwargs={'title': title})
+		# changes of other lines, or of other words of the same line, are merged
+		r = client.post(url, {'content': base.replace(u"Line 5 ", u"Line five ")\
+				.replace(u"Line 7", u"Row 7"), 'description': u'', 'prev_revision': first_revision.pk})
+		self.assertEqual(r.status_code, 302)
+		last_revision = models.Page.objects.get(title=title).last_revision()
+		self.assertEqual(last_revision.content, base.replace(u"Line 2 ", u"Line two ")\
+				.replace(u"Line 5 ", u"Line five ").replace(u"Line 7 of the", u"Row 7 of this"))
+		# while changes of the same words are returned as conflicts
+		r = client.post(url, {'content': base.replace(u"Line 2 ", u"Line deux "),
+				'description': u'', 'prev_revision': first_revision.pk})
+		self.assertEqual(r.status_code, 200)
+		conflicts = r.context['form'].conflicts
+		self.assertEqual([(c.line, c.ours, c.theirs) for c in conflicts],
+				[(3, u"Line deux of the page\n", u"Line two of the page\n")])
+		self.assertEqual(r.context['form']['prev_revision'].value(), last_revision.pk)
+		self.assertTrue(u"<<<<<<< latest revision\nLine two of the page\n=======\n"
+				u"Line deux of the page\n>>>>>>> your version\n" in r.context['form'].data['content'])
+		self.assertContains(r, u"Conflict at line 3")
+
+	def test_undo(self):
+		title = u"Undo page"
+		lines = [u"Line %d of the page\n" % i for i in range(10)]
+		self._page_edit(title, u"".join(lines))
+		lines[2] = u"Second line changed\n"
+		self._page_edit(title, u"".join(lines))
+		lines[8] = u"Eighth line changed\n"
+		self._page_edit(title, u"".join(lines))
+		first, middle, last = models.Page.objects.get(title=title).revisions.order_by('created')
+		self.assertEqual((middle.previous_id, last.previous_id), (first.pk, middle.pk))
+		url = reverse('djiki-page-undo', kwargs={'title': title, 'revision_pk': middle.pk})
+		expected = u"".join(lines).replace(u"Second line changed", u"Line 2 of the page")
+		r = Client().get(url)
+		self.assertEqual(r.context['form'].initial['content'], expected)
+		# revisions saved without the patches are undone all the same
+		models.PageRevision.objects.update(previous=None, reverse_patch=u'')
+		r = Client().get(url)
+		self.assertEqual(r.context['form'].initial['content'], expected)
+		call_command('djiki_reindex')
+		middle = models.PageRevision.objects.get(pk=middle.pk)
+		self.assertEqual(middle.previous_id, first.pk)
+		self.assertEqual(diffs.apply_patch(middle.reverse_patch, middle.content),
+				(first.content, True))
+
+	@override_settings(DJIKI_PAGE_CACHE='default')
+	def test_page_cache(self):
+		self._page_edit(u"Cached page", u"Links to [[Cached target]].")
+		url = reverse('djiki-page-view', kwargs={'title': u"Cached page"})
+		client = Client()
+		self.assertContains(client.get(url), u'class="missing"')
+		connection.use_debug_cursor = True
+		try:
+			del connection.queries[:]
+			self.assertContains(client.get(url), u'class="missing"')
+			self.assertEqual(len(connection.queries), 0)
+		finally:
+			connection.use_debug_cursor = None
+		# creating the target purges the linking page
+		self._page_edit(u"Cached target", content1)
+		self.assertNotContains(client.get(url), u'class="missing"')
+		# the page is purged only once the new revision is committed
+		generation_key = pagecache._generation_key(pagecache.page_group(u"Cached page"))
+		generations = []
+		def saved(sender, **kwargs):
+			generations.append(cache.get(generation_key))
+		signals.post_save.connect(saved, sender=models.PageRevision)
+		try:
+			self._page_edit(u"Cached page", u"Changed content.")
+		finally:
+			signals.post_save.disconnect(saved, sender=models.PageRevision)
+		self.assertTrue(generations and generations[0] is not None)
+		self.assertEqual(cache.get(generation_key), None)
+		self.assertContains(client.get(url), u"Changed content.")
+		# as tagging a page purges the lists
+		list_url = reverse('page_list')
+		self.assertNotContains(client.get(list_url, {'tag': u"cached"}), u"Cached page")
+		tags.set_tags(models.Page.objects.get(title=u"Cached page"), [u"cached"])
+		self.assertContains(client.get(list_url, {'tag': u"cached"}), u"Cached page")
+		# logged in users are never served cached pages
+		user_client = Client()
+		user_client.login(username='foouser', password='foopassword')
+		self.assertContains(user_client.get(url), u"Changed content.")
+		connection.use_debug_cursor = True
+		try:
+			del connection.queries[:]
+			self.assertContains(user_client.get(url), u"Changed content.")
+			self.assertNotEqual(len(connection.queries), 0)
+		finally:
+			connection.use_debug_cursor = None
+
+	def test_undo_compacted(self):
+		title = u"Compacted undo page"
+		lines = [u"Line %d of the page\n" % i for i in range(10)]
+		contents = []
+		for i in range(7):
+			lines[i] = u"Line %d changed\n" % i
+			contents.append(u"".join(lines))
+			self._page_edit(title, contents[-1])
+		call_command('djiki_compact', interval=4)
+		stored = models.PageRevision.objects.filter(page__title=title).order_by('created')
+		self.assertTrue(stored.exclude(delta=u'').exists())
+		# as saved before the patches were introduced
+		stored.update(previous=None, reverse_patch=u'')
+		call_command('djiki_reindex')
+		revisions = list(stored)
+		for previous, revision in zip(revisions, revisions[1:]):
+			self.assertEqual(revision.previous_id, previous.pk)
+			self.assertEqual(diffs.apply_patch(revision.reverse_patch, revision.content),
+					(previous.content, True))
+		r = Client().get(reverse('djiki-page-undo',
+				kwargs={'title': title, 'revision_pk': revisions[3].pk}))
+		self.assertEqual(r.context['form'].initial['content'],
+				contents[-1].replace(u"Line 3 changed", u"Line 3 of the page"))
+
+	def test_merge(self):
+		base = [u"%d\n" % (i % 7) for i in range(200)]
+		ours, theirs = list(base), list(base)
+		ours[10:12] = [u"ours\n"]
+		theirs[150] = u"theirs\n"
+		del theirs[3]
+		result = merge.merge(u"".join(base), u"".join(ours), u"".join(theirs))
+		self.assertEqual(result.conflicts, [])
+		del ours[3]
+		ours[148] = u"theirs\n"
+		self.assertEqual(result.text(), u"".join(ours))
+		self.assertEqual(merge.longest_increasing([(0, 3), (1, 1), (2, 4), (3, 2), (4, 3)]),
+				[(1, 1), (3, 2), (4, 3)])
+
 	def test_anonymous_edits(self):
 		title = u"Auth test page"
 		anon_client = Client()
@@ -122,3 +275,527 @@ class SimpleTest(TestCase):
 		r = user_client.post(reverse('djiki-page-edit', kwargs={'title': title}),
 				{'content': "blah", "description": "", 'prev_revision': last_pk})
 		self.assertEqual(r.status_code, 302)
+
+	def test_rendered_content(self):
+		title = u"Rendered page"
+		self._page_edit(title, content1, description1)
+		revision = models.Page.objects.get(title=title).last_revision()
+		self.assertTrue(revision.rendered_version)
+		self.assertTrue(u'Hello world!' in revision.rendered_content)
+		# the stored output is used instead of parsing the content again
+		models.PageRevision.objects.filter(pk=revision.pk).update(
+				rendered_content=u'<p>stored output</p>')
+		revision = models.PageRevision.objects.get(pk=revision.pk)
+		self.assertEqual(revision.render(), u'<p>stored output</p>')
+		r = Client().get(reverse('djiki-page-view', kwargs={'title': title}))
+		self.assertEqual(r.status_code, 200)
+
+	def test_image_lookups_batched(self):
+		content = u"\n".join(u"{{Image %d.png|Title %d}} [[Page %d]]" % (i, i, i) for i in range(20))
+		self.assertNumQueries(2, parser.render, content)
+		self.assertNumQueries(0, parser.render, u"[[http://example.com]] {{http://example.com/image.png}}")
+
+	def test_section_cache(self):
+		content = u"Intro [[Section page]]\n= One =\nText\n{{{\n= not a header\n}}}\n== Two ==\n* item\n"
+		self.assertEqual(parser.split_sections(content), [u"Intro [[Section page]]\n",
+				u"= One =\nText\n{{{\n= not a header\n}}}\n", u"== Two ==\n* item\n"])
+		html = parser.render(content)
+		self.assertEqual(html, parser.DjikiHtmlEmitter(parser.Parser(content).parse()).emit().encode('utf-8'))
+		# the missing linked page is looked up again
+		self.assertNumQueries(1, parser.render, content)
+		self.assertNumQueries(0, parser.render, content.replace(u"[[Section page]]", u""))
+		# only the changed section is parsed again
+		self.assertNumQueries(1, parser.render, content.replace(u"Text", u"[[Other page]]"))
+		# creating a linked page changes the sections linking to it, and
+		# only those
+		generation = cache.get(parser.GENERATION_KEY)
+		self._page_edit(u"Section page", u"Linked.")
+		self.assertEqual(cache.get(parser.GENERATION_KEY), generation)
+		self.assertFalse('class="missing"' in parser.render(content))
+
+	def test_preview(self):
+		url = reverse('djiki-page-preview', kwargs={'title': u"Preview page"})
+		self.assertEqual(Client().get(url).status_code, 405)
+		r = Client().post(url, {'content': content1})
+		self.assertEqual(r.status_code, 200)
+		self.assertTrue(u'Hello world!' in r.content.decode('utf-8'))
+		self.assertFalse(models.Page.objects.filter(title=u"Preview page").exists())
+		self.assertEqual(parser.split_sections(u"a\nb\n\nc\n", paragraphs=True), [u"a\nb\n\n", u"c\n"])
+		# no slot left for another preview of the same client
+		cache.set('djiki-preview:addr:127.0.0.1', 2)
+		self.assertEqual(Client().post(url, {'content': content1}).status_code, 429)
+		cache.delete('djiki-preview:addr:127.0.0.1')
+
+	def test_worker_pool(self):
+		done = []
+		pool = tasks.WorkerPool(0)
+		self.assertTrue(pool.submit('task', done.append, 1))
+		pool = tasks.WorkerPool(1)
+		pool.submit('task', done.append, 2)
+		pool.join()
+		self.assertEqual(done, [1, 2])
+
+	@override_settings(DJIKI_BACKGROUND_RENDER=True)
+	def test_background_render(self):
+		# a pool whose tasks wait until they are run here
+		pool = tasks.WorkerPool(1)
+		pool.start = lambda: None
+		saved_pool, tasks._pool = tasks._pool, pool
+		try:
+			title = u"Background page"
+			self._page_edit(title, u"First content.")
+			pool.run(*pool.queue.get())
+			self._page_edit(title, u"Second content.")
+			url = reverse('djiki-page-view', kwargs={'title': title})
+			r = Client().get(url)
+			self.assertContains(r, u"First content.")
+			self.assertContains(r, u'class="stale"')
+			self.assertTrue('no-store' in r['Cache-Control'])
+			pool.run(*pool.queue.get())
+			r = Client().get(url)
+			self.assertContains(r, u"Second content.")
+			self.assertNotContains(r, u'class="stale"')
+			# past the timeout, the revision is rendered right away
+			with self.settings(DJIKI_RENDER_STALE_TIMEOUT=0):
+				self._page_edit(title, u"Third content.")
+				self.assertContains(Client().get(url), u"Third content.")
+		finally:
+			tasks._pool = saved_pool
+
+	def test_rerender(self):
+		for i in range(3):
+			self._page_edit(u"Rerendered %d" % i, u"Content of page %d." % i)
+		models.PageRevision.objects.filter(page__title__in=[u"Rerendered 0", u"Rerendered 2"])\
+				.update(rendered_content=u'', rendered_version=u'old')
+		out = StringIO()
+		call_command('djiki_rerender', workers=0, batch_size=1, stdout=out)
+		self.assertTrue(u"2 pages rendered" in out.getvalue())
+		revision = models.Page.objects.get(title=u"Rerendered 2").last_revision()
+		self.assertEqual(revision.rendered_version, parser.render_version())
+		self.assertTrue(u"Content of page 2." in revision.rendered_content)
+		out = StringIO()
+		call_command('djiki_rerender', workers=0, stdout=out)
+		self.assertTrue(u"0 pages rendered" in out.getvalue())
+
+	@override_settings(DJIKI_WORKER_THREADS=0)
+	def test_thumbnail_placeholder(self):
+		self.assertEqual(parser.extract_image_sizes(u"{{Photo.png|100x100|A photo}} {{Photo.png}}"),
+				{u"Photo.png": set([u"100x100"])})
+		image = models.Image.objects.create(name=u"Photo.png")
+		models.ImageRevision.objects.create(image=image, file=u"djimages/missing.png")
+		content = u"{{Photo.png|100x100|A photo}}"
+		self.assertTrue('class="pending"' in parser.render(content))
+		cache.set(thumbnails.cache_key(u"djimages/missing.png", u"100x100"),
+				{'url': u"/media/thumb.png", 'width': 100, 'height': 80})
+		self.assertTrue('src="/media/thumb.png"' in parser.render(content))
+		# the thumbnails are made from the image storage
+		sources = []
+		def fake_thumbnail(source, size):
+			sources.append(source)
+			raise IOError
+		get_thumbnail, thumbnails.get_thumbnail = thumbnails.get_thumbnail, fake_thumbnail
+		try:
+			thumbnails.generate(u"djimages/other.png", [u"100x100"])
+		finally:
+			thumbnails.get_thumbnail = get_thumbnail
+		self.assertEqual([(s.name, s.storage) for s in sources], [(u"djimages/other.png", image_storage)])
+
+	@override_settings(DJIKI_WORKER_THREADS=0)
+	def test_image_storage(self):
+		location, image_storage.location = image_storage.location, tempfile.mkdtemp()
+		try:
+			for name in (u"First.png", u"Second.png"):
+				upload = StringIO('same bytes')
+				upload.name = 'upload.PNG'
+				r = Client().post(reverse('djiki-image-new'), {'name': name, 'file': upload,
+						'description': u"Upload"})
+				self.assertEqual(r.status_code, 302)
+			files = set(models.ImageRevision.objects.values_list('file', flat=True))
+			digest = hashlib.sha1('same bytes').hexdigest()
+			self.assertEqual(files, set([u"djimages/%s/%s/%s.png" % (digest[:2], digest[2:4], digest)]))
+			orphan = image_storage.save(u"djimages/orphan.png", ContentFile('other bytes'))
+			call_command('djiki_gc_images', min_age=-60, verbosity=0)
+			self.assertFalse(image_storage.exists(orphan))
+			self.assertTrue(image_storage.exists(files.pop()))
+		finally:
+			shutil.rmtree(image_storage.location)
+			image_storage.location = location
+
+	def test_benchmark(self):
+		sizes = (100, 1000)
+		corpus = benchmark.CorpusGenerator(pages=2, history=3, images=1, sizes=sizes).generate()
+		self.assertEqual(corpus, {'pages': 3, 'history': 3, 'images': 1})
+		results = benchmark.Benchmark(repeat=1, sizes=sizes).run()
+		self.assertTrue('render_1000' in results and 'form_rebase' in results)
+		self.assertEqual(results['render_100_cached']['queries'], 0)
+
+	def test_timing(self):
+		middleware = settings.MIDDLEWARE_CLASSES + ('djiki.timing.TimingMiddleware',)
+		url = reverse('djiki-page-preview', kwargs={'title': u"Timed page"})
+		with self.settings(MIDDLEWARE_CLASSES=middleware):
+			r = Client().post(url, {'content': u"Some **text** with {{Timed image.png}}."})
+		self.assertTrue(r['Server-Timing'].startswith('total;dur='))
+		self.assertTrue('render;dur=' in r['Server-Timing'])
+		self.assertTrue('image;dur=' in r['Server-Timing'])
+		self.assertTrue(r.request['PATH_INFO'] in [s['path'] for s in timing.get_stats()])
+		self.assertEqual(Client().get(reverse('djiki-timing-stats')).status_code, 403)
+
+	def test_title_resolver(self):
+		self._page_edit(u"Resolved page", content1)
+		page = models.Page.objects.get(title=u"Resolved page")
+		self.assertEqual(resolver.pages.resolve_many([u"Resolved page", u"Unknown page"]), {
+				u"Resolved page": (page.pk, page.current_revision_id, page.current_revision.created,
+					None),
+				u"Unknown page": None})
+		# missing titles are not remembered, but looked up again
+		self.assertNumQueries(1, resolver.pages.resolve, u"Unknown page")
+		self.assertNumQueries(0, resolver.pages.resolve, u"Resolved page")
+		# creating the page makes it known at once
+		self._page_edit(u"Unknown page", content1)
+		self.assertTrue(resolver.pages.resolve(u"Unknown page"))
+
+	def test_page_index(self):
+		for title in (u"apple", u"Avocado", u"banana", u"42"):
+			self._page_edit(title, content1)
+		self.assertEqual(models.get_page_index(), [(u"#", 1), (u"A", 2), (u"B", 1)])
+		r = Client().get(reverse('page_list'))
+		self.assertEqual(r.context['letter'], u"#")
+		r = Client().get(reverse('page_list'), {'letter': u"A"})
+		self.assertEqual([p['title'] for p in r.context['page_list']], [u"Avocado", u"apple"])
+		r = Client().get(reverse('page_list'), {'order': u"modified"})
+		self.assertEqual([p['title'] for p in r.context['page_list']], [u"42", u"banana", u"Avocado", u"apple"])
+		models.Page.objects.update(initial=u"")
+		call_command('djiki_reindex')
+		self.assertEqual(models.get_page_index(), [(u"#", 1), (u"A", 2), (u"B", 1)])
+
+	def test_backlinks(self):
+		self._page_edit(u"Linking page", u"See [[Target page]] and {{Some image.png}}.")
+		self.assertTrue('class="missing"' in models.PageRevision.objects.get(
+				page__title=u"Linking page").rendered_content)
+		self.assertEqual(list(models.PageLink.objects.values_list('kind', 'target').order_by('kind')),
+				[(u'image', u'Some image.png'), (u'page', u'Target page')])
+		self._page_edit(u"Target page", u"Linked from elsewhere.")
+		revision = models.PageRevision.objects.get(page__title=u"Linking page")
+		self.assertEqual(revision.rendered_version, '')
+		self.assertFalse('class="missing"' in revision.render())
+		r = Client().get(reverse('djiki-page-backlinks', kwargs={'title': u"Target page"}))
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual([p.title for p in r.context['backlinks']], [u"Linking page"])
+		revision.render()
+		models.Page.objects.get(title=u"Target page").delete()
+		revision = models.PageRevision.objects.get(page__title=u"Linking page")
+		self.assertEqual(revision.rendered_version, '')
+		self.assertTrue('class="missing"' in revision.render())
+
+	def test_search(self):
+		self._page_edit(u"Cooking", u"Recipes for apple pie and apple juice.")
+		self._page_edit(u"Apple", u"A fruit.")
+		self._page_edit(u"Gardening", u"Growing pears.")
+		simple = search.SimpleBackend()
+		for revision in models.PageRevision.objects.filter(current_version=True):
+			simple.update(revision.page, revision.content)
+		for backend in (search.get_backend(), simple):
+			results = search.SearchResults(u"apple", backend)
+			self.assertEqual(results.count(), 2)
+			self.assertEqual([p.title for p in results[0:10]], [u"Apple", u"Cooking"])
+			self.assertEqual([p.title for p in search.SearchResults(u"apple juice", backend)[0:10]],
+					[u"Cooking"])
+		r = Client().get(reverse('search'), {'q': u'pears'})
+		self.assertEqual([p.title for p in r.context['results'].object_list], [u"Gardening"])
+
+	def test_overlapping_saves(self):
+		self._page_edit(u"Overlapping page", content1)
+		first = models.Page.objects.get(title=u"Overlapping page")
+		second = models.Page.objects.get(title=u"Overlapping page")
+		# both know the same latest revision
+		base = second.last_revision()
+		models.PageRevision(page=first, content=content2).save()
+		revision = models.PageRevision(page=second, content=content3)
+		revision.save()
+		revisions = models.PageRevision.objects.filter(page=first).order_by('created')
+		self.assertEqual(list(revisions.filter(current_version=True)), [revision])
+		self.assertEqual([r.previous_id for r in revisions], [None, base.pk, revisions[1].pk])
+
+	def test_delta_storage(self):
+		title = u"Delta page"
+		contents = [content1, content2, content3, content2, content1 + u"The end.", content3]
+		settings.DJIKI_REVISION_KEYFRAME_INTERVAL = 3
+		try:
+			for content in contents:
+				self._page_edit(title, content)
+		finally:
+			settings.DJIKI_REVISION_KEYFRAME_INTERVAL = 0
+		stored = models.PageRevision.objects.filter(page__title=title).order_by('created')
+		self.assertEqual([bool(d) for d in stored.values_list('delta', flat=True)],
+				[False, True, True, False, True, False])
+		self.assertEqual([r.content for r in stored], contents)
+		self.assertEqual([r.content for r in stored.defer('rendered_content')], contents)
+		call_command('djiki_compact', interval=2)
+		self.assertEqual([bool(d) for d in stored.values_list('delta', flat=True)],
+				[False, True, False, True, False, False])
+		self.assertEqual([r.content for r in stored], contents)
+		call_command('djiki_compact')
+		self.assertFalse(stored.exclude(delta='').exists())
+		self.assertEqual(list(stored.values_list('content', flat=True)), contents)
+
+	def test_current_revision(self):
+		title = u"Pointer page"
+		self._page_edit(title, content1)
+		self._page_edit(title, content2)
+		page = models.Page.objects.select_related('current_revision').get(title=title)
+		self.assertEqual(page.current_revision, page.revisions.order_by('-created')[0])
+		self.assertNumQueries(0, page.last_revision)
+		self.assertEqual(list(page.revisions.filter(current_version=True)), [page.current_revision])
+
+	def test_diff(self):
+		title = u"Long page"
+		lines = [u"Line %d." % i for i in range(100)]
+		self._page_edit(title, u"\n".join(lines))
+		lines[50] = u"Changed line."
+		self._page_edit(title, u"\n".join(lines))
+		old, new = models.PageRevision.objects.filter(page__title=title).order_by('created')
+		diff = diffs.get_diff(old.pk, new.pk)
+		self.assertNumQueries(0, diffs.get_diff, old.pk, new.pk)
+		html = diffs.render_html(diff, 3, expand_url='?context=all')
+		self.assertTrue(u'Line 46.' not in html and u'Line 54.' not in html)
+		self.assertTrue(u'Line 47.' in html and u'Line 53.' in html)
+		self.assertEqual(html.count(u'class="gap"'), 2)
+		self.assertEqual(diffs.render_html(diff).count(u'Line 5'), 10)
+		r = Client().get(reverse('djiki-page-diff', kwargs={'title': title}),
+				{'from_revision_pk': old.pk, 'to_revision_pk': new.pk})
+		self.assertEqual(r.status_code, 200)
+
+	def test_history_pagination(self):
+		title = u"Busy page"
+		for i in range(7):
+			self._page_edit(title, u"Version %d" % i, u"Edit %d" % i)
+		client = Client()
+		seen = []
+		after = None
+		settings.DJIKI_HISTORY_PER_PAGE = 3
+		try:
+			while True:
+				r = client.get(reverse('djiki-page-history', kwargs={'title': title}),
+						{'after': after} if after else {})
+				self.assertEqual(r.status_code, 200)
+				self.assertTrue(len(r.context['history']) <= 3)
+				seen.extend(rev.description for rev in r.context['history'])
+				after = r.context['next_cursor']
+				if not after:
+					break
+		finally:
+			del settings.DJIKI_HISTORY_PER_PAGE
+		self.assertEqual(seen, [u"Edit %d" % i for i in reversed(range(7))])
+		r = client.get(reverse('recent_list'))
+		self.assertEqual([rev.page.title for rev in r.context['page_list']], [title])
+
+	def test_conditional_get(self):
+		title = u"Cached page"
+		self._page_edit(title, content1)
+		client = Client()
+		url = reverse('djiki-page-view', kwargs={'title': title})
+		r = client.get(url)
+		self.assertEqual(r.status_code, 200)
+		etag = r['ETag']
+		self.assertTrue(r.has_header('Last-Modified'))
+		r = client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(r.status_code, 304)
+		self.assertNotEqual(client.get(url, {'raw': 1})['ETag'], etag)
+		revision = models.Page.objects.get(title=title).last_revision()
+		r = client.get(reverse('djiki-page-revision', kwargs={'title': title, 'revision_pk': revision.pk}))
+		self.assertTrue('max-age' in r['Cache-Control'])
+		self._page_edit(title, content2)
+		r = client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(r.status_code, 200)
+		# creating a linked page changes the HTML of the linking one
+		self._page_edit(title, u"Links to [[Validated target]].")
+		r = client.get(url)
+		self.assertContains(r, u'class="missing"')
+		etag = r['ETag']
+		self._page_edit(u"Validated target", content1)
+		r = client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(r.status_code, 200)
+		self.assertNotContains(r, u'class="missing"')
+		# a diff showing pending messages is neither validated nor kept
+		revisions = models.Page.objects.get(title=title).revisions.order_by('created')
+		diff_url = reverse('djiki-page-diff', kwargs={'title': title})
+		data = {'from_revision_pk': revisions[0].pk, 'to_revision_pk': revisions[1].pk}
+		r = client.get(diff_url, data)
+		self.assertTrue('max-age' in r['Cache-Control'])
+		etag = r['ETag']
+		client.cookies['messages'] = 'pending'
+		r = client.get(diff_url, data, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(r.status_code, 200)
+		self.assertFalse('max-age' in r['Cache-Control'])
+		self.assertTrue('no-store' in r['Cache-Control'])
+
+	def test_export_import(self):
+		self._page_edit(u"Exported page", content1, description1, self.user1.username, self.password1)
+		self._page_edit(u"Exported page", content2, description2)
+		models.Page.objects.get(title=u"Exported page").tags.add(u"export")
+		out = StringIO()
+		stdout, sys.stdout = sys.stdout, out
+		try:
+			call_command('djiki_export')
+		finally:
+			sys.stdout = stdout
+		models.Page.objects.all().delete()
+		stdin, sys.stdin = sys.stdin, StringIO(out.getvalue())
+		try:
+			call_command('djiki_import', batch_size=1)
+		finally:
+			sys.stdin = stdin
+		page = models.Page.objects.get(title=u"Exported page")
+		self.assertEqual([t.name for t in page.tags.all()], [u"export"])
+		self.assertEqual(page.last_revision().content, content2)
+		self.assertEqual([(r.description, r.author) for r in page.revisions.order_by('created')],
+				[(description1, self.user1), (description2, None)])
+		self.assertEqual(page.revisions.filter(current_version=True).count(), 1)
+		self.assertTrue(page.last_revision().current_version)
+		# pages linking to the imported ones are rendered again
+		page.delete()
+		self._page_edit(u"Importing page", u"Links to [[Exported page]].")
+		linking = models.PageRevision.objects.get(page__title=u"Importing page")
+		self.assertTrue('class="missing"' in linking.rendered_content)
+		stdin, sys.stdin = sys.stdin, StringIO(out.getvalue())
+		try:
+			call_command('djiki_import')
+		finally:
+			sys.stdin = stdin
+		linking = models.PageRevision.objects.get(pk=linking.pk)
+		self.assertEqual(linking.rendered_version, '')
+		self.assertTrue(linking.links_changed)
+		self.assertFalse('class="missing"' in linking.render())
+
+	def test_tags(self):
+		client = Client()
+		for title, tag_names in ((u"Tagged one", u"red, blue"), (u"Tagged two", u"red"),
+				(u"Tagged three", u"red, blue")):
+			r = client.post(reverse('djiki-page-edit', kwargs={'title': title}),
+					{'content': content1, 'description': u'', 'prev_revision': u'', 'tags': tag_names})
+			self.assertEqual(r.status_code, 302)
+		self.assertEqual(models.Page.objects.get(title=u"Tagged one").tag_list(), [u"blue", u"red"])
+		self.assertEqual([(t['name'], t['count']) for t in tags.get_cloud()],
+				[(u"blue", 2), (u"red", 3)])
+		self.assertEqual(sorted(tags.tagged_pages([u"red", u"blue"]).values_list('title', flat=True)),
+				[u"Tagged one", u"Tagged three"])
+		r = client.get(reverse('tag_list'), {'tag': [u"blue", u"red"]})
+		self.assertContains(r, u"Tagged three")
+		self.assertNotContains(r, u"Tagged two")
+		models.Page.objects.get(title=u"Tagged three").delete()
+		self.assertEqual([(t['name'], t['count']) for t in tags.get_cloud()],
+				[(u"blue", 1), (u"red", 2)])
+		models.TagCount.objects.all().delete()
+		tags.recount()
+		self.assertEqual([(t['name'], t['count']) for t in tags.get_cloud()],
+				[(u"blue", 1), (u"red", 2)])
+
+
+class QueryBudgetTest(TestCase):
+	"""
+	Checks that the number of queries of every view stays within its budget,
+	whatever the number of links, images and revisions of the page shown.
+	"""
+	budgets = {
+		'view': 4,
+		'view_stored': 1,
+		'history': 2,
+		'diff': 4,
+		'undo': 2,
+		'revert': 2,
+		'edit': 1,
+		'backlinks': 2,
+		'search': 3,
+		'list': 3,
+		'tags': 3,
+		'recent': 1,
+		'image': 2,
+		'image_history': 2,
+	}
+	sizes = (1, 5, 20)
+
+	def setUp(self):
+		settings.DJIKI_SPACES_AS_UNDERSCORES = False
+		# the rolled back pages of other tests may still be remembered, and
+		# their reused primary keys may still key cached diffs
+		cache.clear()
+		resolver.pages.invalidate()
+		resolver.images.invalidate()
+		self.author = User.objects.create(username='budgetuser')
+
+	def _populate(self, size):
+		"""
+		Creates a page with `size` revisions, linking to `size` existing and
+		`size` missing pages and embedding `size` images.
+		"""
+		prefix = u"Size %d" % size
+		images = [models.Image.objects.create(name=u"%s image %d.png" % (prefix, i)) for i in range(size)]
+		for image in images:
+			revision = models.ImageRevision(image=image, author=self.author,
+					file=u"djimages/%s-%d.png" % (size, image.pk))
+			# thumbnails are made in the background, out of the requests
+			for thumbnail_size in thumbnails.standard_sizes():
+				cache.set(thumbnails.cache_key(revision.file.name, thumbnail_size),
+						{'url': u"/media/thumbnail.png", 'width': 1, 'height': 1})
+			revision.save()
+		for i in range(size):
+			page = models.Page.objects.create(title=u"%s linked %d" % (prefix, i))
+			tags.set_tags(page, [u"common", u"tag %d" % (i % 3)])
+			models.PageRevision.objects.create(page=page, author=self.author,
+					content=u"Linked page %d" % i)
+		page = models.Page.objects.create(title=u"%s page" % prefix)
+		tags.set_tags(page, [u"common"])
+		content = u"\n".join([u"[[%s linked %d]] [[%s missing %d]] {{%s image %d.png}}" % (
+				prefix, i, prefix, i, prefix, i) for i in range(size)])
+		for i in range(size):
+			models.PageRevision.objects.create(page=page, author=self.author,
+					content=u"== Revision %d ==\n%s" % (i, content), description=u"Edit %d" % i)
+		return page
+
+	def _count(self, url, data=None):
+		connection.use_debug_cursor = True
+		try:
+			del connection.queries[:]
+			r = Client().get(url, data or {})
+			self.assertEqual(r.status_code, 200, u"%s returned %d" % (url, r.status_code))
+			return len(connection.queries)
+		finally:
+			connection.use_debug_cursor = None
+
+	def _measure(self, page):
+		counts = {}
+		revisions = list(page.revisions.order_by('created').values_list('pk', flat=True))
+		image = models.Image.objects.filter(name__startswith=page.title[:-len(u" page")])[0]
+		kwargs = {'title': page.title}
+		models.PageRevision.objects.filter(page=page).update(rendered_version='')
+		parser.invalidate_sections()
+		counts['view'] = self._count(reverse('djiki-page-view', kwargs=kwargs))
+		counts['view_stored'] = self._count(reverse('djiki-page-view', kwargs=kwargs))
+		counts['history'] = self._count(reverse('djiki-page-history', kwargs=kwargs))
+		cache.delete(diffs.cache_key(revisions[0], revisions[-1]))
+		counts['diff'] = self._count(reverse('djiki-page-diff', kwargs=kwargs),
+				{'from_revision_pk': revisions[0], 'to_revision_pk': revisions[-1]})
+		counts['undo'] = self._count(reverse('djiki-page-undo',
+				kwargs={'title': page.title, 'revision_pk': revisions[-1]}))
+		counts['revert'] = self._count(reverse('djiki-page-revert',
+				kwargs={'title': page.title, 'revision_pk': revisions[0]}))
+		counts['edit'] = self._count(reverse('djiki-page-edit', kwargs=kwargs))
+		counts['backlinks'] = self._count(reverse('djiki-page-backlinks', kwargs=kwargs))
+		counts['search'] = self._count(reverse('search'), {'q': u"linked"})
+		counts['list'] = self._count(reverse('page_list'))
+		counts['tags'] = self._count(reverse('tag_list'), {'tag': [u"common", u"tag 0"]})
+		counts['recent'] = self._count(reverse('recent_list'))
+		counts['image'] = self._count(reverse('djiki-image-view', kwargs={'name': image.name}))
+		counts['image_history'] = self._count(reverse('djiki-image-history',
+				kwargs={'name': image.name}))
+		return counts
+
+	@override_settings(DJIKI_WORKER_THREADS=0)
+	def test_query_budgets(self):
+		measured = [self._measure(self._populate(size)) for size in self.sizes]
+		for view, budget in self.budgets.iteritems():
+			counts = [m[view] for m in measured]
+			self.assertTrue(counts[-1] <= budget,
+					u"%s view made %d queries, over its budget of %d" % (view, counts[-1], budget))
+			self.assertEqual(counts, [counts[0]] * len(counts),
+					u"queries of the %s view grow with the data: %s" % (view, counts))
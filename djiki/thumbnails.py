@@ -0,0 +1,73 @@
+import logging
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import cache
+from sorl.thumbnail import get_thumbnail
+from sorl.thumbnail.images import ImageFile
+
+from . import models, tasks
+from .storage import image_storage
+
+logger = logging.getLogger('djiki.thumbnails')
+
+def standard_sizes():
+    return getattr(settings, 'DJIKI_THUMBNAIL_SIZES', ('912x912', '920x920', '200x150'))
+
+def cache_timeout():
+    return getattr(settings, 'DJIKI_THUMBNAIL_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+# how long a thumbnail that failed is not tried again
+FAILURE_TIMEOUT = 60 * 10
+
+def cache_key(name, size):
+    return 'djiki-thumbnail:%s:%s' % (md5(name.encode('utf-8')).hexdigest(), size)
+
+def get_ready(name, size):
+    """
+    Returns a dict with the url, width and height of the thumbnail, None if
+    it is not ready yet or False if it cannot be made.
+    """
+    return cache.get(cache_key(name, size))
+
+def embedded_sizes(image_name):
+    """
+    Returns the sizes the image is embedded with on the pages linking to it.
+    """
+    from .parser import extract_image_sizes
+    sizes = set()
+    revisions = models.PageRevision.objects.filter(current_version=True,
+            page__links__kind=models.PageLink.IMAGE, page__links__target=image_name)
+    for revision in revisions.iterator():
+        sizes.update(extract_image_sizes(revision.content).get(image_name, ()))
+    return sizes
+
+def generate(name, sizes, image_name=None):
+    """
+    Makes the thumbnails of the file. If some of them is new and
+    `image_name` is given, the pages embedding the image are rendered again.
+    """
+    made = False
+    if image_name:
+        sizes = set(sizes) | embedded_sizes(image_name)
+    for size in sizes:
+        key = cache_key(name, size)
+        if cache.get(key) is not None:
+            continue
+        try:
+            # a bare name would be looked up in the default storage
+            thumbnail = get_thumbnail(ImageFile(name, storage=image_storage), size)
+        except Exception:
+            logger.exception("Cannot make the %s thumbnail of %s", size, name)
+            cache.set(key, False, FAILURE_TIMEOUT)
+            continue
+        cache.set(key, {'url': thumbnail.url, 'width': thumbnail.width,
+                'height': thumbnail.height}, cache_timeout())
+        made = True
+    if made and image_name:
+        models.invalidate_backlinks(models.PageLink.IMAGE, image_name)
+
+def schedule(name, sizes=None, image_name=None):
+    if sizes is None:
+        sizes = standard_sizes()
+    sizes = tuple(sorted(sizes))
+    tasks.submit(('thumbnails', name, sizes, image_name), generate, name, sizes, image_name)
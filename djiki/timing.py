@@ -0,0 +1,118 @@
+import json
+import logging
+import threading
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+logger = logging.getLogger('djiki.timing')
+
+_local = threading.local()
+
+STATS_KEY = 'djiki-timing-stats'
+STATS_TIMEOUT = 60 * 60 * 24 * 7
+
+def stats_size():
+    return getattr(settings, 'DJIKI_TIMING_STATS_SIZE', 100)
+
+
+class timed(object):
+    """
+    Adds the time and the database queries spent in the block, or in the
+    decorated function, to the timings of the current request. Does
+    nothing unless TimingMiddleware records the request.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = getattr(_local, 'timings', None)
+        if self.timings is not None:
+            self.queries = len(connection.queries)
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            entry = self.timings.setdefault(self.name, [0.0, 0, 0])
+            entry[0] += time.time() - self.start
+            entry[1] += 1
+            entry[2] += len(connection.queries) - self.queries
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def update_stats(path, duration, queries):
+    """
+    Adds the request to the statistics kept in the cache, which retain the
+    slowest paths only. Concurrent updates may get lost.
+    """
+    stats = cache.get(STATS_KEY) or {}
+    count, total, slowest, total_queries = stats.get(path, (0, 0.0, 0.0, 0))
+    stats[path] = (count + 1, total + duration, max(slowest, duration), total_queries + queries)
+    if len(stats) > stats_size():
+        del stats[min(stats, key=lambda p: stats[p][2])]
+    cache.set(STATS_KEY, stats, STATS_TIMEOUT)
+
+def get_stats():
+    """
+    Returns the statistics of the recorded paths, slowest first.
+    """
+    stats = []
+    for path, (count, total, slowest, queries) in (cache.get(STATS_KEY) or {}).iteritems():
+        stats.append({'path': path, 'count': count, 'average': total / count * 1000,
+                'slowest': slowest * 1000, 'queries': float(queries) / count})
+    stats.sort(key=lambda s: s['slowest'], reverse=True)
+    return stats
+
+
+class TimingMiddleware(object):
+    """
+    Records the time and queries spent in each request and in the timed
+    parts of djiki, and reports them in the Server-Timing header, in a log
+    line and in the statistics shown by the djiki-timing-stats view.
+    """
+
+    def process_request(self, request):
+        _local.timings = {}
+        _local.start = time.time()
+        # the queries are only counted by the debug cursor
+        _local.debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        _local.queries = len(connection.queries)
+
+    def process_response(self, request, response):
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return response
+        _local.timings = None
+        connection.use_debug_cursor = _local.debug_cursor
+        duration = time.time() - _local.start
+        queries = connection.queries[_local.queries:]
+        db_time = sum(float(q['time']) for q in queries)
+        metrics = ['total;dur=%.1f' % (duration * 1000),
+                'db;dur=%.1f;desc="%d queries"' % (db_time * 1000, len(queries))]
+        for name, (elapsed, calls, name_queries) in sorted(timings.iteritems()):
+            metrics.append('%s;dur=%.1f;desc="%d calls, %d queries"' % (
+                    name.replace('.', '-'), elapsed * 1000, calls, name_queries))
+        response['Server-Timing'] = ', '.join(metrics)
+        logger.info(json.dumps({
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'duration': round(duration * 1000, 1),
+            'queries': len(queries),
+            'db': round(db_time * 1000, 1),
+            'timings': dict((name, {'duration': round(elapsed * 1000, 1), 'calls': calls,
+                    'queries': name_queries}) for name, (elapsed, calls, name_queries)
+                    in timings.iteritems()),
+        }, sort_keys=True))
+        update_stats(request.path, duration, len(queries))
+        return response
@@ -1,17 +1,22 @@
 from django.conf.urls.defaults import *
-from . import views
+from . import pagecache, views
+
+cache_list = pagecache.cache_anonymous(pagecache.LISTS)
 
 urlpatterns = patterns('',
-    url(r'^special/all/', views.AllView.as_view(), name='page_list'),
-    url(r'^special/tags/', views.TagView.as_view(), name='tag_list'),
-    url(r'^special/recent/', views.RecentView.as_view(), name='recent_list'),
+    url(r'^special/all/', cache_list(views.AllView.as_view()), name='page_list'),
+    url(r'^special/tags/', cache_list(views.TagView.as_view()), name='tag_list'),
+    url(r'^special/recent/', cache_list(views.RecentView.as_view()), name='recent_list'),
+    url(r'^special/timing/', views.timing_stats, name='djiki-timing-stats'),
     url(r'^search', views.search, name='search'),
     url(r'^special/create', views.create, name='create'),
     url(r'^(?P<title>[^/]+)$', views.view, name='djiki-page-view'),
     url(r'^(?P<title>[^/]+)/edit/$', views.edit, name='djiki-page-edit'),
+    url(r'^(?P<title>[^/]+)/preview/$', views.preview, name='djiki-page-preview'),
     url(r'^(?P<title>[^/]+)/history/$', views.history, name='djiki-page-history'),
     url(r'^(?P<title>[^/]+)/history/(?P<revision_pk>[0-9]+)/$', views.view, name='djiki-page-revision'),
     url(r'^(?P<title>[^/]+)/diff/$', views.diff, name='djiki-page-diff'),
+    url(r'^(?P<title>[^/]+)/backlinks/$', views.backlinks, name='djiki-page-backlinks'),
     url(r'^(?P<title>[^/]+)/undo/(?P<revision_pk>[0-9]+)/$', views.undo, name='djiki-page-undo'),
     url(r'^(?P<title>[^/]+)/revert/(?P<revision_pk>[0-9]+)/$', views.revert, name='djiki-page-revert'),
     url(r'^image/$', views.image_new, name='djiki-image-new'),
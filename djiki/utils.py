@@ -1,22 +1,75 @@
 import re
+from datetime import datetime
+from diff_match_patch import diff_match_patch
 from django.conf import settings
 from django.db.models import Q
+from django.utils import timezone
 
 def spaces_as_underscores():
         return getattr(settings, 'DJIKI_SPACES_AS_UNDERSCORES', True)
 
+spaces_re = re.compile(r'\s+')
+underscores_re = re.compile(r'[_\s]+')
+anchor_re = re.compile(r'[^\w_,\.-]+', re.UNICODE)
+
 def urlize_title(title):
     if spaces_as_underscores():
-        return re.sub(r'\s+', '_', title)
+        return spaces_re.sub('_', title)
     return title
 
 def deurlize_title(title):
     if spaces_as_underscores():
-        return re.sub(r'[_\s]+', ' ', title)
+        return underscores_re.sub(' ', title)
     return title
 
 def anchorize(txt):
-    return re.compile(r'[^\w_,\.-]+', re.UNICODE).sub('_', txt).strip('_')
+    return anchor_re.sub('_', txt).strip('_')
+
+def history_per_page():
+    return getattr(settings, 'DJIKI_HISTORY_PER_PAGE', 50)
+
+cursor_format = '%Y%m%d%H%M%S%f'
+
+def make_cursor(revision):
+    return '%s-%d' % (revision.created.strftime(cursor_format), revision.pk)
+
+def parse_cursor(cursor):
+    try:
+        created, pk = cursor.split('-')
+        created = datetime.strptime(created, cursor_format)
+        pk = int(pk)
+    except ValueError:
+        return None
+    if settings.USE_TZ:
+        created = timezone.make_aware(created, timezone.utc)
+    return created, pk
+
+def paginate_revisions(queryset, cursor=None, per_page=None):
+    """
+    Returns a page of revisions, the latest first, starting after the given
+    cursor, along with the cursor of the next page or None if it is the last
+    one. Unlike with offsets, the cost does not depend on how deep into the
+    history the page is.
+    """
+    per_page = per_page or history_per_page()
+    queryset = queryset.order_by('-created', '-pk')
+    position = cursor and parse_cursor(cursor)
+    if position:
+        created, pk = position
+        queryset = queryset.filter(Q(created__lt=created) | Q(created=created, pk__lt=pk))
+    revisions = list(queryset[:per_page + 1])
+    if len(revisions) > per_page:
+        return revisions[:per_page], make_cursor(revisions[per_page - 1])
+    return revisions, None
+
+def make_delta(src, dst):
+    """Returns a compact, exact description of changes turning src into dst."""
+    dmp = diff_match_patch()
+    return dmp.diff_toDelta(dmp.diff_main(src, dst))
+
+def apply_delta(src, delta):
+    dmp = diff_match_patch()
+    return dmp.diff_text2(dmp.diff_fromDelta(src, delta))
 
 
 def normalize_query(query_string,
@@ -31,24 +84,3 @@ def normalize_query(query_string,
 
     '''
     return [normspace(' ', (t[0] or t[1]).strip()) for t in findterms(query_string)]
-
-def get_query(query_string, search_fields):
-    ''' Returns a query, that is a combination of Q objects. That combination
-        aims to search keywords within a model by testing the given search fields.
-
-    '''
-    query = None # Query to search for every search term
-    terms = normalize_query(query_string)
-    for term in terms:
-        or_query = None # Query to search for a given term in each field
-        for field_name in search_fields:
-            q = Q(**{"%s__icontains" % field_name: term})
-            if or_query is None:
-                or_query = q
-            else:
-                or_query = or_query | q
-        if query is None:
-            query = or_query
-        else:
-            query = query & or_query
-    return query
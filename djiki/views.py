@@ -1,31 +1,134 @@
+from functools import wraps
+from hashlib import md5
 from urllib import urlencode, quote
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseNotFound
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseNotFound
 from django.shortcuts import get_object_or_404, render, redirect
 from django.template import RequestContext, loader
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext as _
 from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition, require_POST
 from django.views.generic.simple import direct_to_template
 from django.views.generic import ListView
 
-from diff_match_patch import diff_match_patch
-from . import models, forms, utils
+from . import models, forms, pagecache, parser, rendering, resolver, utils, diffs, storage, timing
 
 from djiki.models import Page, PageRevision
-from djiki.utils import get_query
-
-from taggit.models import TaggedItem
+from djiki.search import SearchResults
+from djiki.tags import get_cloud, tagged_pages
 
 def allow_anonymous_edits():
         return getattr(settings, 'DJIKI_ALLOW_ANONYMOUS_EDITS', True)
 
+def search_results_per_page():
+    return getattr(settings, 'DJIKI_SEARCH_RESULTS_PER_PAGE', 20)
+
 def user_or_site(request):
     return request.META['REMOTE_ADDR'] == getattr(settings, "SITE_IP", '127.0.0.1') or request.user.is_authenticated()
 
+def preview_concurrency():
+    return getattr(settings, 'DJIKI_PREVIEW_CONCURRENCY', 2)
+
+def revision_max_age():
+    return getattr(settings, 'DJIKI_REVISION_MAX_AGE', 60 * 60 * 24 * 30)
+
+def get_page(title, queryset=None):
+    """
+    Returns the page of the given title, fetched by its primary key known
+    by the title resolver. Titles of missing pages cost no query.
+    """
+    entry = resolver.pages.resolve(title)
+    if not entry:
+        raise models.Page.DoesNotExist
+    if queryset is None:
+        queryset = models.Page.objects.all()
+    return queryset.get(pk=entry[0])
+
+def get_page_or_404(title, queryset=None):
+    try:
+        return get_page(title, queryset)
+    except models.Page.DoesNotExist:
+        raise Http404
+
+def make_etag(request, *parts):
+    user = request.user.pk if request.user.is_authenticated() else ''
+    parts = (parser.render_version(), user) + parts
+    return md5(u':'.join(unicode(p) for p in parts).encode('utf-8')).hexdigest()
+
+def shown_revision(request, title, revision_pk=None):
+    """
+    Returns the pk, the creation time and the time the link targets last
+    changed of the revision shown under the URL, with a single cheap query
+    done before any rendering.
+    """
+    if not hasattr(request, '_djiki_shown_revision'):
+        request._djiki_shown_revision = None
+        # pending messages must be shown, instead of a copy without them
+        if user_or_site(request) and title == utils.urlize_title(title) \
+                and not pagecache.pending_messages(request):
+            page_title = utils.deurlize_title(title)
+            if revision_pk:
+                revisions = models.PageRevision.objects.filter(pk=revision_pk, page__title=page_title)
+                try:
+                    request._djiki_shown_revision = revisions.values_list(
+                            'pk', 'created', 'links_changed')[0]
+                except IndexError:
+                    pass
+            else:
+                entry = resolver.pages.resolve(page_title)
+                if entry and entry[1]:
+                    request._djiki_shown_revision = entry[1:]
+    return request._djiki_shown_revision
+
+def view_etag(request, title, revision_pk=None):
+    revision = shown_revision(request, title, revision_pk)
+    if revision:
+        # the HTML also changes when the pages and images it refers to do
+        return make_etag(request, 'view', revision[0], revision[2],
+                request.REQUEST.get('raw', ''))
+
+def history_etag(request, title):
+    revision = shown_revision(request, title)
+    if revision:
+        return make_etag(request, 'history', revision[0], request.GET.get('after', ''))
+
+def revision_last_modified(request, title, revision_pk=None):
+    revision = shown_revision(request, title, revision_pk)
+    if revision:
+        return max(revision[1], revision[2] or revision[1])
+
+def diff_etag(request, title):
+    if user_or_site(request) and title == utils.urlize_title(title) \
+            and not pagecache.pending_messages(request):
+        # the compared revisions never change
+        return make_etag(request, 'diff', title, request.GET.get('from_revision_pk', ''),
+                request.GET.get('to_revision_pk', ''), request.GET.get('context', ''))
+
+def cache_for_long(request, response):
+    if pagecache.pending_messages(request):
+        # the messages are shown once, and must not be kept with the page
+        patch_cache_control(response, no_cache=True, no_store=True, must_revalidate=True)
+    elif request.user.is_authenticated():
+        patch_cache_control(response, private=True, max_age=revision_max_age())
+    else:
+        patch_cache_control(response, public=True, max_age=revision_max_age())
+    return response
+
+def view_group(request, title, revision_pk=None):
+    # older revisions carry a message, and are cached by the browsers
+    if not revision_pk and user_or_site(request):
+        return pagecache.page_group(utils.deurlize_title(title))
+
+@condition(etag_func=view_etag, last_modified_func=revision_last_modified)
+@pagecache.cache_anonymous(view_group)
 def view(request, title, revision_pk=None):
     if not user_or_site(request):
         return redirect_to_login(request.get_full_path())
@@ -37,7 +140,7 @@ def view(request, title, revision_pk=None):
         return HttpResponseRedirect(reverse('djiki-page-view', kwargs={'title': url_title}))
     page_title = utils.deurlize_title(title)
     try:
-        page = models.Page.objects.get(title=page_title)
+        page = get_page(page_title, models.Page.objects.select_related('current_revision'))
     except models.Page.DoesNotExist:
         t = loader.get_template('djiki/not_found.html')
         c = RequestContext(request, {'title': page_title})
@@ -54,13 +157,21 @@ def view(request, title, revision_pk=None):
                     'url': reverse('djiki-page-view', kwargs={'title': url_title})}))
     else:
         revision = page.last_revision()
+    stale = False
     if request.REQUEST.get('raw', ''):
         response = HttpResponse(mimetype='text/plain')
         response['Content-Disposition'] = 'attachment; filename=%s.txt' % quote(title.encode('utf-8'))
         response.write(revision.content)
-        return response
-    return direct_to_template(request, 'djiki/view.html',
-            {'page': page, 'revision': revision})
+    else:
+        html, stale = rendering.get_html(revision)
+        response = direct_to_template(request, 'djiki/view.html',
+                {'page': page, 'revision': revision, 'html': mark_safe(html), 'stale': stale})
+        if stale:
+            # never kept by the browsers, nor by the page cache
+            patch_cache_control(response, no_cache=True, no_store=True, must_revalidate=True)
+    if revision_pk and not stale:
+        cache_for_long(request, response)
+    return response
 
 def edit(request, title):
     if not allow_anonymous_edits() and not request.user.is_authenticated():
@@ -70,7 +181,7 @@ def edit(request, title):
         return HttpResponseRedirect(reverse('djiki-page-edit', kwargs={'title': url_title}))
     page_title = utils.deurlize_title(title)
     try:
-        page = models.Page.objects.get(title=page_title)
+        page = get_page(page_title, models.Page.objects.select_related('current_revision'))
         last_content = page.last_revision().content
     except models.Page.DoesNotExist:
         page = models.Page(title=page_title)
@@ -97,6 +208,42 @@ def edit(request, title):
     return direct_to_template(request, 'djiki/edit.html',
             {'form': form, 'page': page, 'preview_content': preview_content})
 
+@require_POST
+def preview(request, title):
+    """
+    Returns the HTML of the submitted content alone, for the edit page to
+    show while the text is being written.
+    """
+    if not allow_anonymous_edits() and not request.user.is_authenticated():
+        return HttpResponseForbidden()
+    if request.user.is_authenticated():
+        key = 'djiki-preview:user:%d' % request.user.pk
+    else:
+        key = 'djiki-preview:addr:%s' % request.META['REMOTE_ADDR']
+    # the timeout bounds how long a crashed request may hold its slot
+    cache.add(key, 0, 60)
+    try:
+        running = cache.incr(key)
+    except ValueError:
+        running = 1
+    try:
+        if running > preview_concurrency():
+            response = HttpResponse(_("Too many previews at once."),
+                    content_type='text/plain; charset=utf-8', status=429)
+            response['Retry-After'] = '1'
+            return response
+        # consecutive previews share most of their paragraphs
+        html = parser.render(request.POST.get('content', ''), paragraphs=True)
+    finally:
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
+    response = HttpResponse(html, content_type='text/html; charset=utf-8')
+    patch_cache_control(response, no_cache=True, private=True)
+    return response
+
+@condition(etag_func=history_etag, last_modified_func=revision_last_modified)
 def history(request, title):
     if not user_or_site(request):
         return redirect_to_login(request.get_full_path())
@@ -104,10 +251,32 @@ def history(request, title):
     if title != url_title:
         return HttpResponseRedirect(reverse('djiki-page-history', kwargs={'title': url_title}))
     page_title = utils.deurlize_title(title)
-    page = get_object_or_404(models.Page, title=page_title)
-    history = page.revisions.order_by('-created')
-    return direct_to_template(request, 'djiki/history.html', {'page': page, 'history': history})
+    page = get_page_or_404(page_title)
+    history, next_cursor = utils.paginate_revisions(
+            page.revisions.defer('content', 'delta', 'reverse_patch',
+                    'rendered_content').select_related('author'),
+            request.GET.get('after'))
+    return direct_to_template(request, 'djiki/history.html',
+            {'page': page, 'history': history, 'after': request.GET.get('after'),
+                'next_cursor': next_cursor})
 
+def backlinks(request, title):
+    if not user_or_site(request):
+        return redirect_to_login(request.get_full_path())
+    url_title = utils.urlize_title(title)
+    if title != url_title:
+        return HttpResponseRedirect(reverse('djiki-page-backlinks', kwargs={'title': url_title}))
+    page_title = utils.deurlize_title(title)
+    try:
+        page = get_page(page_title)
+    except models.Page.DoesNotExist:
+        page = models.Page(title=page_title)
+    backlinks = models.Page.objects.filter(
+            links__kind=models.PageLink.PAGE, links__target=page_title)
+    return direct_to_template(request, 'djiki/backlinks.html',
+            {'page': page, 'backlinks': backlinks})
+
+@condition(etag_func=diff_etag)
 def diff(request, title):
     if not user_or_site(request):
         return redirect_to_login(request.get_full_path())
@@ -115,16 +284,24 @@ def diff(request, title):
     if title != url_title:
         return HttpResponseNotFound()
     page_title = utils.deurlize_title(title)
-    page = get_object_or_404(models.Page, title=page_title)
+    page = get_page_or_404(page_title)
+    revisions = page.revisions.defer('content', 'delta', 'rendered_content')
     try:
-        from_rev = page.revisions.get(pk=request.REQUEST['from_revision_pk'])
-        to_rev = page.revisions.get(pk=request.REQUEST['to_revision_pk'])
-    except (KeyError, models.Page.DoesNotExist):
+        from_rev = revisions.get(pk=request.REQUEST['from_revision_pk'])
+        to_rev = revisions.get(pk=request.REQUEST['to_revision_pk'])
+    except (KeyError, ValueError, models.PageRevision.DoesNotExist):
         return HttpResponseNotFound()
-    dmp = diff_match_patch()
-    diff = dmp.diff_compute(from_rev.content, to_rev.content, True, 2)
-    return direct_to_template(request, 'djiki/diff.html',
-            {'page': page, 'from_revision': from_rev, 'to_revision': to_rev, 'diff': diff})
+    diff = diffs.get_diff(from_rev.pk, to_rev.pk)
+    if request.GET.get('context') == 'all':
+        diff_html = diffs.render_html(diff)
+    else:
+        query = request.GET.copy()
+        query['context'] = 'all'
+        diff_html = diffs.render_html(diff, diffs.context_lines(),
+                expand_url=u'?%s' % query.urlencode())
+    return cache_for_long(request, direct_to_template(request, 'djiki/diff.html',
+            {'page': page, 'from_revision': from_rev, 'to_revision': to_rev,
+                'diff_html': mark_safe(diff_html)}))
 
 def create(request, title=None):
     if request.method =='POST':
@@ -141,8 +318,9 @@ def revert(request, title, revision_pk):
         return HttpResponseRedirect(
                 reverse('djiki-page-revert', kwargs={'title': url_title, 'revision_pk': revision_pk}))
     page_title = utils.deurlize_title(title)
-    page = get_object_or_404(models.Page, title=page_title)
-    src_revision = get_object_or_404(models.PageRevision, page=page, pk=revision_pk)
+    page = get_page_or_404(page_title, models.Page.objects.select_related('current_revision'))
+    src_revision = get_object_or_404(models.PageRevision.objects.select_related('author'),
+            page=page, pk=revision_pk)
     new_revision = models.PageRevision(page=page,
             author=request.user if request.user.is_authenticated() else None)
     if request.method == 'POST':
@@ -153,7 +331,7 @@ def revert(request, title, revision_pk):
     else:
         if src_revision.author:
             description = _("Reverted to revision of %(time)s by %(user)s.") % \
-                    {'time': src_revision.created, 'user': src_revision.user.username}
+                    {'time': src_revision.created, 'user': src_revision.author.username}
         else:
             description = _("Reverted to anonymous revision of %(time)s.") % \
                     {'time': src_revision.created}
@@ -170,8 +348,9 @@ def undo(request, title, revision_pk):
         return HttpResponseRedirect(
                 reverse('djiki-page-undo', kwargs={'title': url_title, 'revision_pk': revision_pk}))
     page_title = utils.deurlize_title(title)
-    page = get_object_or_404(models.Page, title=page_title)
-    src_revision = get_object_or_404(models.PageRevision, page=page, pk=revision_pk)
+    page = get_page_or_404(page_title, models.Page.objects.select_related('current_revision'))
+    src_revision = get_object_or_404(models.PageRevision.objects.select_related('author'),
+            page=page, pk=revision_pk)
     new_revision = models.PageRevision(page=page,
             author=request.user if request.user.is_authenticated() else None)
     if request.method == 'POST':
@@ -182,28 +361,20 @@ def undo(request, title, revision_pk):
     else:
         if src_revision.author:
             description = _("Undid revision of %(time)s by %(user)s.") % \
-                    {'time': src_revision.created, 'user': src_revision.user.username}
+                    {'time': src_revision.created, 'user': src_revision.author.username}
         else:
             description = _("Undid anonymous revision of %(time)s.") % {'time': src_revision.created}
-        try:
-            prev_revision = models.PageRevision.objects\
-                    .filter(page=page, created__lt=src_revision.created)\
-                    .order_by('-created')[0]
-            prev_content = prev_revision.content
-        except IndexError:
-            prev_content = ''
-        dmp = diff_match_patch()
-        rdiff = dmp.patch_make(src_revision.content, prev_content)
-        content, results = dmp.patch_apply(rdiff, page.last_revision().content)
-        if False in results:
+        patch, prev_pk = src_revision.undo_patch()
+        content, applied = diffs.apply_patch(patch, page.last_revision().content)
+        if not applied:
             messages.warning(request, _("It was impossible to automatically undo the change "
                     "you have selected. Perhaps the page has been modified too much in the "
                     "meantime. Review the following content comparison, which represents the "
                     "change you tried to undo, and apply the changes manually to the latest "
                     "revision."))
             urldata = {'to_revision_pk': src_revision.pk}
-            if prev_revision:
-                urldata['from_revision_pk'] = prev_revision.pk
+            if prev_pk:
+                urldata['from_revision_pk'] = prev_pk
             return HttpResponseRedirect("%s?%s" % (
                     reverse('djiki-page-diff', kwargs={'title': url_title}),
                     urlencode(urldata)))
@@ -211,6 +382,18 @@ def undo(request, title, revision_pk):
                 initial={'content': content, 'description': description})
     return direct_to_template(request, 'djiki/edit.html', {'page': page, 'form': form})
 
+def hash_uploads(view):
+    """
+    Hashes uploaded files while they are received. The handlers must be set
+    before the CSRF check reads the request.
+    """
+    view = csrf_protect(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers = [storage.HashingUploadHandler(request)]
+        return view(request, *args, **kwargs)
+    return csrf_exempt(wraps(view)(wrapper))
+
+@hash_uploads
 def image_new(request):
     if not allow_anonymous_edits() and not request.user.is_authenticated():
         return HttpResponseForbidden()
@@ -223,14 +406,19 @@ def image_new(request):
                     reverse('djiki-image-view', kwargs={'name': form.instance.image.name}))
     return direct_to_template(request, 'djiki/image_edit.html', {'form': form})
 
+@pagecache.cache_anonymous(lambda request, name: pagecache.image_group(utils.deurlize_title(name)))
 def image_view(request, name):
     url_name = utils.urlize_title(name)
     if name != url_name:
         return HttpResponseRedirect(reverse('djiki-image-view', kwargs={'name': url_name}))
     image_name = utils.deurlize_title(name)
-    image = get_object_or_404(models.Image, name=image_name)
-    return direct_to_template(request, 'djiki/image_view.html', {'image': image})
+    image = get_object_or_404(models.Image.objects.select_related('current_revision'),
+            name=image_name)
+    pages = models.Page.objects.filter(
+            links__kind=models.PageLink.IMAGE, links__target=image_name)
+    return direct_to_template(request, 'djiki/image_view.html', {'image': image, 'pages': pages})
 
+@hash_uploads
 def image_edit(request, name):
     if not allow_anonymous_edits() and not request.user.is_authenticated():
         return redirect_to_login(request.get_full_path())
@@ -256,41 +444,119 @@ def image_history(request, name):
         return HttpResponseRedirect(reverse('djiki-image-view', kwargs={'name': url_name}))
     image_name = utils.deurlize_title(name)
     image = get_object_or_404(models.Image, name=image_name)
-    history = image.revisions.order_by('-created')
-    return direct_to_template(request, 'djiki/image_history.html', {'image': image, 'history': history})
+    history, next_cursor = utils.paginate_revisions(
+            image.revisions.select_related('author'), request.GET.get('after'))
+    return direct_to_template(request, 'djiki/image_history.html',
+            {'image': image, 'history': history, 'after': request.GET.get('after'),
+                'next_cursor': next_cursor})
+
+def page_index_per_page():
+    return getattr(settings, 'DJIKI_PAGE_INDEX_PER_PAGE', 100)
 
 class AllView(ListView):
-    model = Page
+    """
+    Lists the pages of one initial letter, of one tag or by the time of
+    their last change, a page at a time, with the cached table of initials.
+    """
     template_name = 'djiki/page_list.html'
-    # TODO want to be able to group by headings of
-    # first letter
-    # tag
-    # date modified
+    context_object_name = 'page_list'
+
+    def get_paginate_by(self, queryset):
+        return page_index_per_page()
+
+    def get_queryset(self):
+        self.index = models.get_page_index()
+        self.tag = self.request.GET.get('tag')
+        self.order = self.request.GET.get('order')
+        self.letter = None
+        pages = Page.objects.all()
+        if self.tag:
+            pages = pages.filter(tags__name=self.tag).order_by('title')
+        elif self.order == 'modified':
+            pages = pages.filter(modified__isnull=False).order_by('-modified')
+        else:
+            self.letter = self.request.GET.get('letter') or (self.index and self.index[0][0])
+            pages = pages.filter(initial=self.letter).order_by('title')
+        return pages.values('title', 'modified')
+
+    def get_context_data(self, **kwargs):
+        context = super(AllView, self).get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context.update({
+            'index': self.index,
+            'letter': self.letter,
+            'tag': self.tag,
+            'order': self.order,
+            'query': query.urlencode(),
+            # cheaper than reversing the URL of every listed page
+            'page_url': reverse('djiki-page-view', kwargs={'title': '_'})[:-1],
+        })
+        return context
 
 class TagView(ListView):
-    model = TaggedItem
+    """
+    Shows the tag cloud, along with the pages having all the tags given as
+    `tag` parameters, a page at a time.
+    """
     template_name = 'djiki/tag_list.html'
-    queryset = TaggedItem.objects.filter(content_type__name='page').order_by('tag')
     context_object_name = 'page_list'
 
+    def get_paginate_by(self, queryset):
+        return page_index_per_page()
+
+    def get_queryset(self):
+        self.tags = self.request.GET.getlist('tag')
+        if not self.tags:
+            return Page.objects.none()
+        return tagged_pages(self.tags).order_by('title').values('title', 'modified')
+
+    def get_context_data(self, **kwargs):
+        context = super(TagView, self).get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context.update({
+            'cloud': get_cloud(),
+            'tags': self.tags,
+            'query': query.urlencode(),
+            'page_url': reverse('djiki-page-view', kwargs={'title': '_'})[:-1],
+        })
+        return context
+
 class RecentView(ListView):
     model = PageRevision
     template_name = 'djiki/recent_list.html'
-    queryset = TaggedItem.objects.filter(content_type__name='page').order_by('tag')
-    queryset = PageRevision.objects.filter(current_version=True).order_by('-created')
     context_object_name = 'page_list'
 
+    def get_queryset(self):
+        revisions = PageRevision.objects.filter(current_version=True)\
+                .defer('content', 'delta', 'rendered_content').select_related('page', 'author')
+        page_list, self.next_cursor = utils.paginate_revisions(
+                revisions, self.request.GET.get('after'))
+        return page_list
+
+    def get_context_data(self, **kwargs):
+        context = super(RecentView, self).get_context_data(**kwargs)
+        context['after'] = self.request.GET.get('after')
+        context['next_cursor'] = self.next_cursor
+        return context
+
 
 def search(request):
-    query_string = ''
-    found_entries = None
-    if ('q' in request.GET) and request.GET['q'].strip():
-        query_string = request.GET['q']
-        print query_string
-        entry_query = get_query(query_string, ['page__title', 'content',])
-        found_entries = PageRevision.objects.filter(entry_query, 
-                current_version=True) #.order_by('-pub_date')
-        print len(found_entries)
-        # found_entries = PageRevision.objects.filter(content__icontains=query_string)
+    query_string = request.GET.get('q', '').strip()
+    results = None
+    if query_string:
+        paginator = Paginator(SearchResults(query_string), search_results_per_page())
+        try:
+            results = paginator.page(request.GET.get('page', 1))
+        except PageNotAnInteger:
+            results = paginator.page(1)
+        except EmptyPage:
+            results = paginator.page(paginator.num_pages)
     return render(request, 'djiki/search_results.html',
-            { 'query_string': query_string, 'found_entries': found_entries })
+            {'query_string': query_string, 'results': results})
+
+def timing_stats(request):
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    return direct_to_template(request, 'djiki/timing_stats.html', {'stats': timing.get_stats()})